@@ -0,0 +1,96 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vg_pipeline'))
+
+from annotation import NERPool, NERWorker
+
+
+# Speaks the CRFClassifier slashTags line protocol: capitalized tokens are
+# PERSON, everything else O. A sentence containing MISMATCH loses a tag.
+STUB_TAGGER = r'''
+import sys
+
+for line in iter(sys.stdin.readline, ''):
+    tokens = line.split()
+
+    if 'MISMATCH' in tokens:
+        tokens = tokens[:-1]
+
+    sys.stdout.write(' '.join('%s/%s' % (token, 'PERSON' if token[0].isupper() else 'O') for token in tokens) + '\n')
+    sys.stdout.flush()
+'''
+
+
+def _expected(sent):
+    return [(token, 'PERSON' if token[0].isupper() else 'O') for token in sent]
+
+
+class NERTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stub_fn = os.path.join(self.tmp_dir, 'stub_tagger.py')
+
+        with open(self.stub_fn, 'w') as f:
+            f.write(STUB_TAGGER)
+
+        self.command = [sys.executable, self.stub_fn]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_worker_empty_sentences(self):
+        worker = NERWorker(self.command)
+
+        try:
+            sentences = [['Ola', 'bor', 'i', 'Oslo'], [], ['hei'], []]
+
+            self.assertEqual(worker.tag_sents(sentences), [_expected(sent) for sent in sentences])
+            self.assertEqual(worker.tag_sents([[]]), [[]])
+            self.assertEqual(worker.tag_sents([]), [])
+        finally:
+            worker.close()
+
+    def test_worker_restarts_after_mismatch(self):
+        worker = NERWorker(self.command)
+
+        try:
+            sentences = [['a', 'b'], ['x', 'MISMATCH'], ['Kari', 'kom'], ['c']]
+            process = worker.process
+
+            self.assertRaises(ValueError, worker.tag_sents, sentences)
+            self.assertIsNot(worker.process, process)
+
+            # Later calls are not shifted by replies left over from the failed one
+            sentences = [['Per', 'gikk'], ['d']]
+            self.assertEqual(worker.tag_sents(sentences), [_expected(sent) for sent in sentences])
+        finally:
+            worker.close()
+
+    def test_batch_tag_chunks(self):
+        pool = NERPool(2, self.command, chunk_size=3)
+        chunk_sizes = []
+        tag_sents = pool.tag_sents
+
+        def recording_tag_sents(sentences):
+            chunk_sizes.append(len(sentences))
+            return tag_sents(sentences)
+
+        pool.tag_sents = recording_tag_sents
+
+        try:
+            sentences = [['Ola', str(i)] if i % 4 else [] for i in xrange(10)]
+            tagged = pool.batch_tag(iter(sentences))
+
+            self.assertEqual(tagged, [_expected(sent) for sent in sentences])
+            self.assertEqual(sorted(chunk_sizes), [1, 3, 3, 3])
+            self.assertEqual(pool.batch_tag([]), [])
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
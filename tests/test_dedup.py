@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vg_pipeline'))
+
+from dedup import DedupIndex
+from store import ArticleStore
+
+
+TEXT = u'Regjeringen legger i dag frem statsbudsjettet for neste år, med store kutt i bistand og ' \
+       u'nye penger til samferdsel, forsvar og politi over hele landet.'
+
+
+class DedupIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.store = ArticleStore(self.store_path, index=False)
+        self.index = DedupIndex(self.store)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.store_path)
+
+    def _check_and_add(self, art_id, text):
+        signature, duplicate_of = self.index.check(art_id, text)
+        self.index.add(art_id, signature)
+
+        return duplicate_of
+
+    def test_near_duplicate(self):
+        self.assertIsNone(self._check_and_add(1, TEXT))
+        self.assertEqual(self._check_and_add(2, TEXT.replace(u'i dag', u'nå')), 1)
+        self.assertEqual(self.store.near_duplicate_ids([1, 2]), set([2]))
+
+    def test_texts_without_words_are_not_duplicates(self):
+        for art_id, text in enumerate([u'', None, u' . , !', u''], 1):
+            self.assertIsNone(self._check_and_add(art_id, text))
+
+        self.assertEqual(self.store.minhash_art_ids(), set())
+        self.assertEqual(self.store.near_duplicate_ids([1, 2, 3, 4]), set())
+
+        self.assertIsNone(self._check_and_add(5, TEXT))
+        self.assertIsNone(self._check_and_add(6, u''))
+
+    def test_add_without_art_id(self):
+        signature, duplicate_of = self.index.check(None, TEXT)
+        self.index.add(None, signature)
+
+        self.assertEqual(self.store.minhash_art_ids(), set())
+
+        self.assertIsNone(self._check_and_add(1, TEXT))
+        self.assertEqual(self.store.minhash_art_ids(), set([1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
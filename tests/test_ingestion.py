@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vg_pipeline'))
+
+import ingestion
+
+
+ENTRY = {'link': 'http://www.vg.no/nyheter/i/abc/?artid=1', 'title': 'Title'}
+
+
+class FeedEntriesTest(unittest.TestCase):
+    def setUp(self):
+        self.parse = ingestion.feedparser.parse
+        self.requests = []
+
+    def tearDown(self):
+        ingestion.feedparser.parse = self.parse
+
+    def _respond(self, feed_doc):
+        def parse(url, etag=None, modified=None):
+            self.requests.append((etag, modified))
+            return feed_doc
+
+        ingestion.feedparser.parse = parse
+
+    def test_new_validators_replace_old(self):
+        feed_state = {'etag': 'a', 'modified': 'Mon'}
+        self._respond({'status': 200, 'etag': 'b', 'modified': 'Tue', 'entries': [ENTRY]})
+
+        self.assertEqual(len(ingestion.feed_entries('url', feed_state)), 1)
+        self.assertEqual(self.requests, [('a', 'Mon')])
+        self.assertEqual(feed_state, {'etag': 'b', 'modified': 'Tue'})
+
+    def test_missing_validators_are_kept(self):
+        feed_state = {'etag': 'a', 'modified': 'Mon'}
+        self._respond({'status': 200, 'modified': 'Tue', 'entries': [ENTRY]})
+
+        ingestion.feed_entries('url', feed_state)
+        self.assertEqual(feed_state, {'etag': 'a', 'modified': 'Tue'})
+
+    def test_failed_fetches_keep_state(self):
+        for feed_doc in [{'status': 500, 'etag': 'b', 'entries': []},
+                         {'status': 200, 'bozo': 1, 'etag': 'b', 'modified': 'Tue', 'entries': [ENTRY]},
+                         {'status': 200, 'etag': 'b', 'modified': 'Tue'},
+                         {'status': 304}]:
+            feed_state = {'etag': 'a', 'modified': 'Mon'}
+            self._respond(feed_doc)
+
+            ingestion.feed_entries('url', feed_state)
+            self.assertEqual(feed_state, {'etag': 'a', 'modified': 'Mon'})
+
+
+if __name__ == '__main__':
+    unittest.main()
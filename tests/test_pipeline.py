@@ -0,0 +1,49 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vg_pipeline'))
+
+from pipeline import IngestionPipeline
+from store import ArticleStore
+
+
+class StubFetcher(object):
+    def fetch(self, url):
+        return 200, {}, '<html><body><p>%s</p></body></html>' % url
+
+    def close(self):
+        pass
+
+
+class IngestionPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.store = ArticleStore(self.store_path, index_backend='native')
+        self.pipeline = IngestionPipeline(self.store, fetch_workers=2, extract_processes=1, fetcher=StubFetcher())
+
+    def tearDown(self):
+        self.pipeline.close()
+        self.store.close()
+        shutil.rmtree(self.store_path)
+
+    def _entries(self, first, count):
+        return [{'url': 'http://www.vg.no/?artid=%d' % art_id, 'art_id': art_id}
+                for art_id in xrange(first, first + count)]
+
+    def test_stats_are_per_run(self):
+        for run in xrange(2):
+            art_ids = self.pipeline.run(self._entries(run * 20 + 1, 20))
+
+            self.assertEqual(sorted(art_ids), range(run * 20 + 1, run * 20 + 21))
+
+            for name, stats in self.pipeline.stage_stats().items():
+                self.assertEqual((stats['processed'], stats['failed']), (20, 0), name)
+
+        self.assertEqual(len(self.store), 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+VG_PIPELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vg_pipeline')
+sys.path.insert(0, VG_PIPELINE_DIR)
+
+from store import ArticleStore
+
+
+def _article(art_id):
+    return {'art_id': art_id, 'url': 'http://www.vg.no/?artid=%d' % art_id, 'raw_doc': u'<p>Artikkel %d</p>' % art_id,
+            'cooked_doc': u'Artikkel %d' % art_id, 'title': u'', 'summary': u'', 'tags': [], 'date': u''}
+
+
+class RawDictionaryTest(unittest.TestCase):
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+
+        with ArticleStore(self.store_path, index_backend='native') as store:
+            store.add_articles([_article(art_id) for art_id in xrange(1, 6)])
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def _assert_store_opens(self):
+        with ArticleStore(self.store_path, index=False) as store:
+            self.assertEqual(len(store), 5)
+            self.assertEqual(store.get_raw_doc(3), u'<p>Artikkel 3</p>')
+            self.assertEqual(store._conn().execute('select count() from raw_dicts').fetchone()[0], 0)
+
+    def test_train_dictionary_rejected_for_zlib(self):
+        with ArticleStore(self.store_path, index=False) as store:
+            self.assertRaises(ValueError, store.migrate_raw_content, 'zlib', True)
+
+        self._assert_store_opens()
+
+    def test_cli_rejects_train_dictionary_without_zstd(self):
+        with open(os.devnull, 'w') as devnull:
+            returncode = subprocess.call([sys.executable, 'store.py', '--store', self.store_path, '--migrate-raw',
+                                          '--train-dictionary'], cwd=VG_PIPELINE_DIR, stderr=devnull)
+
+        self.assertNotEqual(returncode, 0)
+        self._assert_store_opens()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vg_pipeline'))
+
+import term_index
+from store import ArticleStore
+
+
+class TermIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _add(self, art_id, text):
+        writer = term_index.get_writer(self.path)
+        term_index.index_article(writer, art_id, text)
+        writer.close()
+
+    def test_commits_are_merged(self):
+        for art_id in xrange(1, 51):
+            self._add(art_id, u'artikkel nummer %d om valg' % art_id)
+
+        segments = term_index._read_segments(self.path)
+
+        self.assertLess(len(segments), term_index.MERGE_FACTOR * 2)
+        self.assertEqual(len([fn for fn in os.listdir(self.path) if fn.startswith('seg_')]), len(segments) * 4)
+        self.assertEqual(term_index.indexed_article_ids(self.path), set(xrange(1, 51)))
+        self.assertEqual([art_id for art_id, _ in term_index.search(u'17', index=self.path)], [17])
+
+    def test_merge_keeps_latest_version(self):
+        for art_id in xrange(1, 10):
+            self._add(art_id, u'gammel tekst')
+
+        # Replaces article 1, then the tenth commit merges the first tier
+        self._add(1, u'ny tekst')
+
+        self.assertEqual(len(term_index._read_segments(self.path)), 1)
+        self.assertEqual(term_index.search(u'ny', index=self.path)[0][0], 1)
+        self.assertNotIn(1, [art_id for art_id, _ in term_index.search(u'gammel', index=self.path)])
+
+        self._add(2, u'nyere tekst')
+
+        self.assertNotIn(2, [art_id for art_id, _ in term_index.search(u'gammel', index=self.path)])
+
+    def test_reader_is_reused(self):
+        self._add(1, u'en tekst')
+        reader = term_index._reader(self.path)
+
+        self.assertIs(term_index._reader(self.path), reader)
+
+        self._add(2, u'to tekster')
+        new_reader = term_index._reader(self.path)
+
+        self.assertIsNot(new_reader, reader)
+        self.assertIs(new_reader.segments[0], reader.segments[0])
+        self.assertEqual(term_index.indexed_article_ids(self.path), set([1, 2]))
+
+
+class StoreTermIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def test_update_and_rebuild(self):
+        with ArticleStore(self.store_path, index_backend='native') as store:
+            store.add_articles([{'art_id': art_id, 'url': '', 'raw_doc': u'', 'cooked_doc': u'sak %d' % art_id,
+                                 'title': u'', 'summary': u'', 'tags': [], 'date': u''}
+                                for art_id in xrange(1, 101)])
+
+            self.assertEqual(store.update_term_index(), 0)
+            self.assertEqual(store.update_term_index(rebuild=True, threads=3), 100)
+
+            self.assertEqual(term_index.indexed_article_ids(store.index_path), set(xrange(1, 101)))
+            self.assertEqual(term_index.search(u'42', index=store.index_path)[0][0], 42)
+
+    def test_failed_rebuild_keeps_index(self):
+        with ArticleStore(self.store_path, index_backend='native') as store:
+            store.add_articles([{'art_id': art_id, 'url': '', 'raw_doc': u'', 'cooked_doc': u'sak %d' % art_id,
+                                 'title': u'', 'summary': u'', 'tags': [], 'date': u''}
+                                for art_id in xrange(1, 51)])
+
+            index_article = term_index.index_article
+
+            def failing_index_article(writer, art_id, art_body, update=False):
+                if art_id == 37:
+                    raise IOError('disk full')
+
+                index_article(writer, art_id, art_body, update)
+
+            term_index.index_article = failing_index_article
+
+            try:
+                self.assertRaises(IOError, store.update_term_index, True, 4)
+            finally:
+                term_index.index_article = index_article
+
+            self.assertEqual(term_index.indexed_article_ids(store.index_path), set(xrange(1, 51)))
+            self.assertFalse(os.path.exists(store.index_path + '.rebuild'))
+
+
+if __name__ == '__main__':
+    unittest.main()
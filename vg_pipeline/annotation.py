@@ -1,11 +1,36 @@
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import Queue
 from subprocess import Popen
-import itertools
-
-from nltk.tag.stanford import NERTagger
+import sys
+import threading
 
 
 PIPE = -1
 
+TREETAGGER_BIN = os.environ.get('VG_TREETAGGER_BIN', 'tree-tagger')
+TREETAGGER_MODEL = os.environ.get('VG_TREETAGGER_MODEL',
+                                  os.path.join('models', 'tree_tagger_2014-03-05.tree_tagger_model'))
+
+# SGML lines are passed through TreeTagger untouched and mark sentence and batch boundaries
+TREETAGGER_BATCH_START = '<vg-batch-start/>'
+TREETAGGER_BATCH_END = '<vg-batch-end/>'
+TREETAGGER_SENT_END = '<vg-sent-end/>'
+
+# TreeTagger holds back a few tokens of lookahead, and its stdout to a pipe is block buffered (4096 bytes with
+# glibc), so the batch end marker only comes through once enough filler output follows it. Every filler '.' comes
+# back as at least 6 bytes ('.\tX\t.\n'), and output left over from one batch is skipped by the next read.
+TREETAGGER_OUTPUT_BUFFER = 4096
+TREETAGGER_LOOKAHEAD = 16
+TREETAGGER_FLUSH_LINES = TREETAGGER_OUTPUT_BUFFER // len('.\tX\t.\n') + TREETAGGER_LOOKAHEAD
+
+NER_MODEL = os.environ.get('VG_NER_MODEL', os.path.join('models', 'nob-ner-model.ser.gz'))
+NER_JAR = os.environ.get('VG_NER_JAR', os.path.join('..', 'tools', 'stanford-ner-2014-01-04', 'stanford-ner.jar'))
+NER_JAVA_MEMORY = '1g'
+NER_WORKERS = int(os.environ.get('VG_NER_WORKERS', 1))
+NER_CHUNK_SIZE = 200
+
 
 def split_tt_line(line):
     word, tag, lemma = line.split('\t')
@@ -14,25 +39,241 @@ def split_tt_line(line):
     return word, tag, lemma
 
 
+class TreeTaggerWorker(object):
+    def __init__(self, binary=TREETAGGER_BIN, model=TREETAGGER_MODEL):
+        self.process = Popen([binary, '-token', '-lemma', '-sgml', '-quiet', model],
+                             shell=False, stdin=PIPE, stdout=PIPE)
+
+        self._lock = threading.Lock()
+
+    def _write(self, sentences):
+        lines = [TREETAGGER_BATCH_START]
+
+        for sent in sentences:
+            lines += sent
+            lines.append(TREETAGGER_SENT_END)
+
+        lines.append(TREETAGGER_BATCH_END)
+        lines += ['.'] * TREETAGGER_FLUSH_LINES
+
+        self.process.stdin.write('\n'.join(lines) + '\n')
+        self.process.stdin.flush()
+
+    def _readline(self):
+        line = self.process.stdout.readline()
+
+        if not line:
+            raise OSError('TreeTagger command failed!')
+
+        return line.rstrip('\n')
+
+    def _read(self):
+        # Skip the filler output left over from the previous batch
+        while self._readline() != TREETAGGER_BATCH_START:
+            pass
+
+        tagged_sents = []
+        sent = []
+
+        while True:
+            line = self._readline()
+
+            if line == TREETAGGER_BATCH_END:
+                return tagged_sents
+            elif line == TREETAGGER_SENT_END:
+                tagged_sents.append(sent)
+                sent = []
+            elif line != "":
+                sent.append(split_tt_line(line))
+
+    def tag_sents(self, sentences):
+        with self._lock:
+            # Write from a separate thread so that a full output pipe can not block the input
+            writer = threading.Thread(target=self._write, args=(sentences, ))
+            writer.start()
+
+            try:
+                return self._read()
+            finally:
+                writer.join()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class WorkerPool(object):
+    def __init__(self, workers):
+        self.workers = workers
+
+        self._idle = Queue.Queue()
+
+        for worker in self.workers:
+            self._idle.put(worker)
+
+    def tag_sents(self, sentences):
+        worker = self._idle.get()
+
+        try:
+            return worker.tag_sents(sentences)
+        finally:
+            self._idle.put(worker)
+
+    def tag_documents(self, documents):
+        pool = ThreadPool(len(self.workers))
+
+        try:
+            return pool.map(self.tag_sents, documents)
+        finally:
+            pool.close()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+class TreeTaggerPool(WorkerPool):
+    def __init__(self, n_workers, binary=TREETAGGER_BIN, model=TREETAGGER_MODEL):
+        WorkerPool.__init__(self, [TreeTaggerWorker(binary, model) for _ in xrange(n_workers)])
+
+
+def ner_command(model=NER_MODEL, jar=NER_JAR):
+    return ['java', '-mx%s' % NER_JAVA_MEMORY, '-cp', jar, 'edu.stanford.nlp.ie.crf.CRFClassifier',
+            '-loadClassifier', model, '-readStdin', '-outputFormat', 'slashTags',
+            '-tokenizerFactory', 'edu.stanford.nlp.process.WhitespaceTokenizer',
+            '-inputEncoding', 'utf-8', '-outputEncoding', 'utf-8']
+
+
+def _encode_token(token):
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+
+    return token.replace(' ', '_')
+
+
+class NERWorker(object):
+    # Line protocol: one whitespace tokenized sentence per input line,
+    # answered by one line of word/TAG pairs.
+    def __init__(self, command=None):
+        self.command = command or ner_command()
+
+        self._lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        self.process = Popen(self.command, shell=False, stdin=PIPE, stdout=PIPE)
+
+    def _restart(self, writer):
+        self.process.kill()
+        writer.join()
+        self.process.wait()
+
+        for f in (self.process.stdin, self.process.stdout):
+            try:
+                f.close()
+            except IOError:
+                pass
+
+        self._start()
+
+    def _write(self, sentences):
+        try:
+            self.process.stdin.write(''.join(' '.join(_encode_token(token) for token in sent) + '\n'
+                                             for sent in sentences))
+            self.process.stdin.flush()
+        except IOError as e:
+            # The process was killed after a failed read, which is reported by tag_sents
+            logging.debug("NER tagger input closed: %s" % e)
+
+    def _read(self, sent):
+        line = self.process.stdout.readline()
+
+        if not line:
+            raise OSError('NER tagger command failed!')
+
+        tags = [token.rsplit('/', 1)[-1] for token in line.split()]
+
+        if len(tags) != len(sent):
+            raise ValueError("NER tagger returned %d tags for %d tokens" % (len(tags), len(sent)))
+
+        return zip(sent, tags)
+
+    def tag_sents(self, sentences):
+        # Empty sentences would not produce an output line
+        non_empty = [sent for sent in sentences if sent]
+
+        with self._lock:
+            writer = threading.Thread(target=self._write, args=(non_empty, ))
+            writer.start()
+
+            try:
+                tagged = iter([self._read(sent) for sent in non_empty])
+            except Exception:
+                exc_info = sys.exc_info()
+
+                # Replies left in the pipe would shift the results of every later call,
+                # and a blocked writer would never finish, so start over with a fresh process
+                self._restart(writer)
+
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            writer.join()
+
+        return [next(tagged) if sent else [] for sent in sentences]
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class NERPool(WorkerPool):
+    def __init__(self, n_workers=NER_WORKERS, command=None, chunk_size=NER_CHUNK_SIZE):
+        WorkerPool.__init__(self, [NERWorker(command) for _ in xrange(n_workers)])
+
+        self.chunk_size = chunk_size
+
+    def batch_tag(self, sentences):
+        sentences = list(sentences)
+        chunks = [sentences[i:i + self.chunk_size] for i in xrange(0, len(sentences), self.chunk_size)]
+
+        return [sent for chunk in self.tag_documents(chunks) for sent in chunk]
+
+
+_treetagger_worker = None
+
+
+def get_treetagger_worker():
+    global _treetagger_worker
+
+    if _treetagger_worker:
+        return _treetagger_worker
+
+    _treetagger_worker = TreeTaggerWorker()
+
+    return _treetagger_worker
+
+
+def annotate_treetagger_sents(sentences):
+    return get_treetagger_worker().tag_sents(sentences)
+
+
 def annotate_treetagger(sentences):
-    p = Popen(['/Users/stinky/Work/tools/treetagger/bin/tree-tagger',
-               '-token', '-lemma', '/Users/stinky/Work/vg-pipeline/models/tree_tagger_2014-03-05.tree_tagger_model'],
-              shell=False, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    return [token for sent in annotate_treetagger_sents(sentences) for token in sent]
+
+
+_ner_pool = None
+
 
-    p.stdin.write('\n'.join(list(itertools.chain(*sentences))))
-    (stdout, stderr) = p.communicate()
-    treetagger_output = stdout
+def get_ner_pool():
+    global _ner_pool
 
-    if p.returncode != 0:
-        print stderr
-        raise OSError('TreeTagger command failed!')
+    if _ner_pool:
+        return _ner_pool
 
-    tagged_sents = [split_tt_line(line) for line in treetagger_output.split('\n') if line != ""]
+    _ner_pool = NERPool()
 
-    return tagged_sents
+    return _ner_pool
 
 
 def annotate_ner(sentences):
-    ner = NERTagger('models/nob-ner-model.ser.gz',
-                    '../tools/stanford-ner-2014-01-04/stanford-ner.jar', encoding='utf-8')
-    return ner.batch_tag(sentences)
+    return get_ner_pool().batch_tag(sentences)
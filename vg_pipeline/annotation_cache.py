@@ -0,0 +1,309 @@
+from collections import OrderedDict
+import cPickle
+import hashlib
+import logging
+from optparse import OptionParser
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from store import ArticleStore, GET_ARTICLES_CHUNK_SIZE, SQLITE_PRAGMAS, SQLITE_TIMEOUT
+
+
+SQL_TABLE_ANNOTATIONS = 'create table if not exists annotations (layer text, key text, version text, data blob, ' \
+                        'size integer, accessed real, primary key (layer, key))'
+SQL_INDEX_ANNOTATIONS_ACCESSED = 'create index if not exists annotations_accessed on annotations (accessed)'
+SQL_SELECT_ANNOTATIONS = 'select key, version, data from annotations where layer = ? and key in (%s)'
+SQL_REPLACE_ANNOTATION = 'insert or replace into annotations (layer, key, version, data, size, accessed) ' \
+                         'values (?, ?, ?, ?, ?, ?)'
+SQL_TOUCH_ANNOTATION = 'update annotations set accessed = ? where layer = ? and key = ?'
+SQL_ANNOTATIONS_SIZE = 'select coalesce(sum(size), 0) from annotations'
+SQL_SELECT_OLDEST_ANNOTATIONS = 'select layer, key, size from annotations order by accessed'
+SQL_DELETE_ANNOTATION = 'delete from annotations where layer = ? and key = ?'
+SQL_DELETE_STALE_ANNOTATIONS = 'delete from annotations where layer = ? and version != ?'
+SQL_ANNOTATION_STATS = 'select layer, count(), coalesce(sum(size), 0) from annotations group by layer'
+
+ANNOTATION_DB_FN = 'annotations.db'
+ANNOTATION_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Evict down to this fraction of the limit so that eviction does not run on every put
+ANNOTATION_EVICT_FRACTION = 0.9
+ANNOTATION_MEMORY_CACHE_SIZE = 1000
+ANNOTATION_ZLIB_LEVEL = 6
+
+ANNOTATION_LAYERS = ['sentences', 'treetagger', 'ner']
+# Bump when the code producing a layer changes in a way that changes its output
+ANNOTATION_LAYER_VERSIONS = {'sentences': 1, 'treetagger': 1, 'ner': 1}
+
+
+def _layer_sources(layer):
+    # Imported on demand so that the cache can be used without loading the taggers
+    import annotation
+    import preprocessing
+
+    if layer == 'sentences':
+        return [preprocessing.NO_PUNKT_MODEL]
+    elif layer == 'treetagger':
+        return _layer_sources('sentences') + [annotation.TREETAGGER_MODEL]
+    elif layer == 'ner':
+        return _layer_sources('sentences') + [annotation.NER_MODEL, annotation.NER_JAR]
+    else:
+        raise ValueError("Unknown annotation layer %s" % layer)
+
+
+def layer_version(layer):
+    # Model files are fingerprinted by size and modification time, so replacing
+    # a model invalidates everything annotated with the old one.
+    fingerprint = ['%s:%d' % (layer, ANNOTATION_LAYER_VERSIONS[layer])]
+
+    for fn in _layer_sources(layer):
+        fn = os.path.abspath(fn)
+
+        if os.path.exists(fn):
+            stat = os.stat(fn)
+            fingerprint.append('%s:%d:%d' % (fn, stat.st_size, int(stat.st_mtime)))
+        else:
+            fingerprint.append('%s:missing' % fn)
+
+    return hashlib.sha1('|'.join(fingerprint)).hexdigest()
+
+
+def text_key(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+
+    return hashlib.sha1(text).hexdigest()
+
+
+def _encode(value):
+    return sqlite3.Binary(zlib.compress(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL), ANNOTATION_ZLIB_LEVEL))
+
+
+def _decode(data):
+    return cPickle.loads(zlib.decompress(str(data)))
+
+
+def _cache_conn(path):
+    conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+
+    for pragma, value in SQLITE_PRAGMAS:
+        conn.execute('pragma %s = %s' % (pragma, value))
+
+    conn.execute(SQL_TABLE_ANNOTATIONS)
+    conn.execute(SQL_INDEX_ANNOTATIONS_ACCESSED)
+    conn.commit()
+
+    return conn
+
+
+def _compute_layer(cache, layer, texts):
+    import annotation
+    import preprocessing
+
+    if layer == 'sentences':
+        return [preprocessing.preprocess(text) for text in texts]
+
+    sentences = cache.annotate('sentences', texts)
+
+    if layer == 'treetagger':
+        return [annotation.annotate_treetagger_sents(sents) for sents in sentences]
+    elif layer == 'ner':
+        return [annotation.annotate_ner(sents) for sents in sentences]
+    else:
+        raise ValueError("Unknown annotation layer %s" % layer)
+
+
+class AnnotationCache(object):
+    def __init__(self, path, max_bytes=ANNOTATION_CACHE_MAX_BYTES, memory_size=ANNOTATION_MEMORY_CACHE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_size = memory_size
+
+        self._conn = _cache_conn(path)
+        self._lock = threading.RLock()
+        self._versions = {}
+        self._memory = OrderedDict()
+
+    def version(self, layer):
+        # Computed once per process, models are not expected to change under a running experiment
+        if layer not in self._versions:
+            self._versions[layer] = layer_version(layer)
+
+        return self._versions[layer]
+
+    def _remember(self, layer, key, value):
+        self._memory[(layer, key)] = value
+
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_many(self, layer, texts):
+        version = self.version(layer)
+        keys = [text_key(text) for text in texts]
+
+        found = {}
+        missing = []
+
+        with self._lock:
+            for key in keys:
+                value = self._memory.pop((layer, key), None)
+
+                if value is not None:
+                    self._remember(layer, key, value)
+                    found[key] = value
+                elif key not in found:
+                    missing.append(key)
+
+            missing = list(set(missing))
+
+            for start in xrange(0, len(missing), GET_ARTICLES_CHUNK_SIZE):
+                chunk = missing[start:start + GET_ARTICLES_CHUNK_SIZE]
+
+                for key, row_version, data in self._conn.execute(SQL_SELECT_ANNOTATIONS % ', '.join('?' * len(chunk)),
+                                                                 [layer] + chunk):
+                    if row_version == version:
+                        found[key] = _decode(data)
+                        self._remember(layer, key, found[key])
+
+            now = time.time()
+            self._conn.executemany(SQL_TOUCH_ANNOTATION, [(now, layer, key) for key in missing if key in found])
+            self._conn.commit()
+
+        return [found.get(key) for key in keys]
+
+    def put_many(self, layer, texts, values):
+        version = self.version(layer)
+        now = time.time()
+
+        rows = []
+
+        with self._lock:
+            for text, value in zip(texts, values):
+                key = text_key(text)
+                data = _encode(value)
+
+                rows.append((layer, key, version, data, len(data), now))
+                self._remember(layer, key, value)
+
+            self._conn.executemany(SQL_REPLACE_ANNOTATION, rows)
+            self._conn.commit()
+
+            self.evict()
+
+    def get(self, layer, text):
+        return self.get_many(layer, [text])[0]
+
+    def put(self, layer, text, value):
+        self.put_many(layer, [text], [value])
+
+    def annotate(self, layer, texts):
+        texts = list(texts)
+        values = self.get_many(layer, texts)
+
+        missing = [i for i, value in enumerate(values) if value is None]
+
+        if missing:
+            computed = _compute_layer(self, layer, [texts[i] for i in missing])
+            self.put_many(layer, [texts[i] for i in missing], computed)
+
+            for i, value in zip(missing, computed):
+                values[i] = value
+
+        return values
+
+    def size(self):
+        with self._lock:
+            return self._conn.execute(SQL_ANNOTATIONS_SIZE).fetchone()[0]
+
+    def evict(self, max_bytes=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+
+        with self._lock:
+            size = self.size()
+
+            if size <= max_bytes:
+                return 0
+
+            target = size - int(max_bytes * ANNOTATION_EVICT_FRACTION)
+            freed = 0
+            evicted = []
+
+            for layer, key, entry_size in self._conn.execute(SQL_SELECT_OLDEST_ANNOTATIONS):
+                if freed >= target:
+                    break
+
+                evicted.append((layer, key))
+                freed += entry_size
+
+            self._conn.executemany(SQL_DELETE_ANNOTATION, evicted)
+            self._conn.commit()
+
+            for entry in evicted:
+                self._memory.pop(entry, None)
+
+        logging.info("Evicted %d annotations (%d bytes) from %s" % (len(evicted), freed, self.path))
+
+        return len(evicted)
+
+    def purge_stale(self):
+        with self._lock:
+            for layer in ANNOTATION_LAYERS:
+                self._conn.execute(SQL_DELETE_STALE_ANNOTATIONS, (layer, self.version(layer)))
+
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            return dict((layer, (count, size)) for layer, count, size in self._conn.execute(SQL_ANNOTATION_STATS))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def annotation_cache_fn(store_path):
+    return os.path.join(store_path, ANNOTATION_DB_FN)
+
+
+def warm_cache(store, cache, layer, batch_size=GET_ARTICLES_CHUNK_SIZE):
+    texts = []
+
+    for article in store.iter_articles(fields=['cooked_doc']):
+        texts.append(article['cooked_doc'])
+
+        if len(texts) >= batch_size:
+            cache.annotate(layer, texts)
+            texts = []
+
+    if texts:
+        cache.annotate(layer, texts)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option('-s', '--store')
+    parser.add_option('-l', '--layer', action='append')
+    parser.add_option('--max-bytes', type=int, default=ANNOTATION_CACHE_MAX_BYTES)
+    parser.add_option('--purge-stale', action='store_true')
+
+    opts, args = parser.parse_args()
+
+    if opts.store:
+        store_path = os.path.abspath(opts.store)
+    else:
+        raise ValueError('--store argument is required')
+
+    with ArticleStore(store_path, index=False) as store:
+        cache = store.annotation_cache(opts.max_bytes)
+
+        if opts.purge_stale:
+            cache.purge_stale()
+
+        for layer in opts.layer or []:
+            warm_cache(store, cache, layer)
+
+        for layer, (count, size) in sorted(cache.stats().items()):
+            logging.info("Layer %s: %d annotations, %d bytes" % (layer, count, size))
@@ -1,42 +1,178 @@
-from collections import Sequence, Iterable
+from collections import Sequence, Iterable, OrderedDict
 import logging
 from optparse import OptionParser
 import os
+import time
 
-from numpy import linspace, unique
+from numpy import linspace, mean, unique
 from numpy.ma import power
-from sklearn.cross_validation import train_test_split
+from sklearn.cross_validation import StratifiedKFold, train_test_split
 from sklearn.externals import joblib
+from sklearn.externals.joblib import Parallel, delayed
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.grid_search import GridSearchCV
 from sklearn.metrics import f1_score, precision_score, recall_score, \
     jaccard_similarity_score, confusion_matrix
+from sklearn.linear_model import SGDClassifier
 from sklearn.pipeline import Pipeline
 from sklearn.svm import SVC
 from sklearn.utils.multiclass import unique_labels
 
+from features import CountTfidfTransformer, FeatureStore, feature_store_path
 from store import ArticleStore
 
 
 TOPICS = {"Nyheter", "Sport", "Rampelys"}
 
+SEQUENCE_CHUNK_SIZE = 500
+SEQUENCE_CACHE_SIZE = 10000
+
+TFIDF_PARAMS = {'max_df': 0.5, 'min_df': 2, 'smooth_idf': True, 'sublinear_tf': True}
+
+C_VALUES = power(10, linspace(-5, 4, num=10))
+CV_FOLDS = 5
+
+SGD_N_ITER = 20
+# Number of C values without improvement before a fold stops walking the regularization path
+FAST_PATIENCE = 2
+
+
+def text_transformer():
+    return 'vect', TfidfVectorizer(strip_accents='unicode', lowercase=True, **TFIDF_PARAMS)
+
+
+def count_transformer():
+    # Works on cached count rows, IDF is fit per training fold
+    return 'tfidf', CountTfidfTransformer(**TFIDF_PARAMS)
+
+
+def svc_pipeline(transformer, c=1.0):
+    return Pipeline([transformer(), ('svm', SVC(kernel='linear', C=c))])
+
+
+def _sgd_alpha(c, n_samples):
+    # Same regularization strength as an SVM with this C on n_samples examples
+    return 1.0 / (c * n_samples)
+
+
+def sgd_pipeline(transformer, c, n_samples, n_iter=SGD_N_ITER):
+    return Pipeline([transformer(),
+                     ('svm', SGDClassifier(loss='hinge', alpha=_sgd_alpha(c, n_samples), n_iter=n_iter))])
+
+
+def _take(data, indices):
+    if hasattr(data, 'shape'):
+        return data[indices]
+    else:
+        return [data[i] for i in indices]
+
+
+def _fold_path(transformer, data, labels, train, test, cs, n_iter, patience):
+    _, vect = transformer()
+    x_train = vect.fit_transform(_take(data, train))
+    x_test = vect.transform(_take(data, test))
+    y_train = _take(labels, train)
+    y_test = _take(labels, test)
+
+    # Walks from strong to weak regularization, each fit starting from the previous solution
+    clf = SGDClassifier(loss='hinge', warm_start=True, n_iter=n_iter)
+    scores = []
+
+    for c in cs:
+        clf.set_params(alpha=_sgd_alpha(c, len(train)))
+        clf.fit(x_train, y_train)
+        scores.append(clf.score(x_test, y_test))
+
+        if len(scores) - 1 - scores.index(max(scores)) >= patience:
+            break
+
+    return scores
+
+
+def fast_search(transformer, data, labels, cs=C_VALUES, n_folds=CV_FOLDS, n_jobs=1, n_iter=SGD_N_ITER,
+                patience=FAST_PATIENCE):
+    cs = sorted(cs)
+    labels = list(labels)
+
+    paths = Parallel(n_jobs=n_jobs)(delayed(_fold_path)(transformer, data, labels, train, test, cs, n_iter, patience)
+                                    for train, test in StratifiedKFold(labels, n_folds=n_folds))
+
+    # Folds that stopped early keep their last score for the remaining C values
+    scores = [mean([path[min(i, len(path) - 1)] for path in paths]) for i in xrange(len(cs))]
+    best = scores.index(max(scores))
+
+    return cs[best], scores[best]
+
+
+def text_model(feature_store, pipeline):
+    # Puts the feature store vocabulary in front of a model fit on cached counts so that it accepts raw text
+    return Pipeline([('vect', feature_store.vectorizer())] + pipeline.steps)
+
 
 class ArticleSequence(Sequence):
-    def __init__(self, store, key='cooked_doc'):
+    def __init__(self, store, key='cooked_doc', art_ids=None,
+                 chunk_size=SEQUENCE_CHUNK_SIZE, cache_size=SEQUENCE_CACHE_SIZE):
         self.store = store
-        self.art_ids = list(store.article_ids())
+
+        if art_ids is None:
+            self.art_ids = list(store.article_ids())
+        else:
+            self.art_ids = list(art_ids)
+
         self.key = key
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+
+        self._cache = OrderedDict()
+
+    def _fetch(self, indices):
+        values = {}
+        missing = []
+
+        for art_id in set(self.art_ids[i] for i in indices):
+            if art_id in self._cache:
+                values[art_id] = self._cache.pop(art_id)
+                self._cache[art_id] = values[art_id]
+            else:
+                missing.append(art_id)
+
+        for article in self.store.get_articles(missing, fields=[self.key]):
+            values[article['art_id']] = article[self.key]
+            self._cache[article['art_id']] = article[self.key]
+
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return values
 
     def _get_index(self, index):
-        article = self.store.get_article_by_id(self.art_ids[index])
+        if index < 0:
+            index += len(self)
+
+        art_id = self.art_ids[index]
+
+        if art_id in self._cache:
+            return self._fetch([index])[art_id]
+
+        # Read ahead so that sequential access is served in chunks
+        return self._fetch(xrange(index, min(index + self.chunk_size, len(self))))[art_id]
+
+    def _get_indices(self, indices):
+        result = []
+
+        for start in xrange(0, len(indices), self.chunk_size):
+            chunk = indices[start:start + self.chunk_size]
 
-        return article[self.key]
+            values = self._fetch(chunk)
+            result += [values[self.art_ids[i]] for i in chunk]
+
+        return result
 
     def __getitem__(self, index):
         if isinstance(index, slice):
-            return [self._get_index(i) for i in xrange(*index.indices(len(self)))]
+            return self._get_indices(range(*index.indices(len(self))))
         elif isinstance(index, Iterable):
-            return [self._get_index(i) for i in index]
+            return self._get_indices(list(index))
         elif isinstance(index, int):
             return self._get_index(index)
         else:
@@ -56,9 +192,9 @@ class FilteredSequence(Sequence):
 
     def __getitem__(self, index):
         if isinstance(index, slice):
-            return [self._get_index(i) for i in xrange(*index.indices(len(self)))]
+            return self._get_indices(xrange(*index.indices(len(self))))
         elif isinstance(index, Iterable):
-            return [self._get_index(i) for i in index]
+            return self._get_indices(index)
         elif isinstance(index, int):
             return self._get_index(index)
         else:
@@ -67,6 +203,15 @@ class FilteredSequence(Sequence):
     def _get_index(self, index):
         return self.base_sequence[self.included_indices[index]]
 
+    def _get_indices(self, indices):
+        base_indices = [self.included_indices[i] for i in indices]
+
+        if isinstance(self.base_sequence, (ArticleSequence, FilteredSequence)):
+            # Let the base sequence fetch the whole selection in chunks
+            return self.base_sequence[base_indices]
+        else:
+            return [self.base_sequence[i] for i in base_indices]
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
@@ -75,11 +220,14 @@ if __name__ == '__main__':
     parser.add_option('-s', '--store')
     parser.add_option('-m', '--model-file')
     parser.add_option('-p', '--num-processes')
+    parser.add_option('--features', action='store_true')
+    parser.add_option('--fast', action='store_true')
+    parser.add_option('--compare-timing', action='store_true')
 
     opts, args = parser.parse_args()
 
     if opts.store:
-        store = os.path.abspath(opts.store)
+        store_path = os.path.abspath(opts.store)
     else:
         raise ValueError('--store argument is required')
 
@@ -93,53 +241,76 @@ if __name__ == '__main__':
     else:
         p = 1
 
-    logging.info("Reading data from store %s" % store)
-    store = ArticleStore(store)
+    logging.info("Reading data from store %s" % store_path)
+    store = ArticleStore(store_path, index=False)
 
-    content = ArticleSequence(store)
-    tags = ArticleSequence(store, key='tags')
-
-    topic_indices = []
+    art_ids = []
     topics = []
 
-    for i, top in enumerate(tags):
-        topic = list(TOPICS & set(top))
+    for article in store.iter_articles(fields=['tags'], tags_any=TOPICS):
+        art_ids.append(article['art_id'])
+        topics.append(sorted(TOPICS & set(article['tags']))[0])
+
+    if opts.features:
+        feature_store = FeatureStore(feature_store_path(store_path))
+        feature_store.update(store)
 
-        if topic:
-            topics += topic
-            topic_indices.append(i)
+        content = feature_store.matrix(art_ids)
+        transformer = count_transformer
+    else:
+        content = ArticleSequence(store, art_ids=art_ids)[:]
+        transformer = text_transformer
 
-    content = list(FilteredSequence(content, topic_indices))
     tags = topics
 
-    logging.info("%d articles in dataset" % len(content))
+    logging.info("%d articles in dataset" % len(art_ids))
     # logging.info("Average %.4f tags pr. article" % (len(list(chain(*tags))) / float(len(tags))))
     # logging.info("%d different tags" % len(unique(list(chain(*tags)))))
     logging.info("%d different tags" % len(unique(tags)))
 
-    train_idx, test_idx = train_test_split(range(len(content)))
-    content_train = FilteredSequence(content, train_idx)
-    content_test = FilteredSequence(content, test_idx)
+    train_idx, test_idx = train_test_split(range(len(art_ids)))
+
+    if opts.features:
+        content_train = content[train_idx]
+        content_test = content[test_idx]
+    else:
+        content_train = FilteredSequence(content, train_idx)
+        content_test = FilteredSequence(content, test_idx)
 
     tags_train = FilteredSequence(tags, train_idx)
     tags_test = FilteredSequence(tags, test_idx)
 
-    pipeline = Pipeline([('vect', TfidfVectorizer(strip_accents='unicode', lowercase=True, max_df=0.5, min_df=2,
-                                                  smooth_idf=True, sublinear_tf=True)),
-                         ('svm', SVC(kernel='linear'))])
+    if opts.fast or opts.compare_timing:
+        logging.info("Running fast meta parameter search")
+        start = time.time()
+
+        c, score = fast_search(transformer, content_train, tags_train, n_jobs=p)
+        fast_time = time.time() - start
+
+        logging.info("Best score %.4f with C = %f in %.1fs" % (score, c, fast_time))
 
-    logging.info("Running meta parameter grid search")
-    grid = GridSearchCV(pipeline, {'svm__C': power(10, linspace(-5, 4, num=10))}, verbose=1, n_jobs=p, cv=5)
+    if not opts.fast or opts.compare_timing:
+        logging.info("Running meta parameter grid search")
+        start = time.time()
 
-    grid.fit(content_train, tags_train)
+        grid = GridSearchCV(svc_pipeline(transformer), {'svm__C': C_VALUES}, verbose=1, n_jobs=p, cv=CV_FOLDS)
+        grid.fit(content_train, tags_train)
+        grid_time = time.time() - start
 
-    c = grid.best_params_['svm__C']
+        logging.info("Best score %.4f with C = %f in %.1fs" % (grid.best_score_, grid.best_params_['svm__C'],
+                                                                grid_time))
 
-    logging.info("Best score %.4f with C = %f" % (grid.best_score_, c))
+    if opts.compare_timing:
+        logging.info("Fast search took %.1fs, grid search %.1fs (%.1fx speedup)" %
+                     (fast_time, grid_time, grid_time / max(fast_time, 1e-6)))
 
-    pipeline = Pipeline([('vect', TfidfVectorizer(strip_accents='unicode', lowercase=True, max_df=0.5, min_df=2,
-                                                  smooth_idf=True, sublinear_tf=True)),
-                         ('svm', SVC(kernel='linear', C=c))])
+    if opts.fast:
+        make_pipeline = lambda c, n_samples: sgd_pipeline(transformer, c, n_samples)
+    else:
+        c = grid.best_params_['svm__C']
+        make_pipeline = lambda c, n_samples: svc_pipeline(transformer, c)
+
+    pipeline = make_pipeline(c, len(train_idx))
     pipeline.fit(content_train, tags_train)
     pred = pipeline.predict(content_test)
 
@@ -151,11 +322,12 @@ if __name__ == '__main__':
 
     logging.info("Training full model")
 
-    pipeline = Pipeline([('vect', TfidfVectorizer(strip_accents='unicode', lowercase=True, max_df=0.5, min_df=2,
-                                                  smooth_idf=True, sublinear_tf=True)),
-                         ('svm', SVC(kernel='linear', C=c))])
+    pipeline = make_pipeline(c, len(art_ids))
     pipeline.fit(content, tags)
 
+    if opts.features:
+        pipeline = text_model(feature_store, pipeline)
+
     if model_fn:
         logging.info("Saving full model to %s" % model_fn)
         joblib.dump(pipeline, model_fn, compress=9)
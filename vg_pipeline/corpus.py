@@ -0,0 +1,336 @@
+from collections import deque
+from itertools import islice
+import logging
+from optparse import OptionParser
+import os
+
+import numpy
+
+from flat_arrays import init_offsets, load_meta, map_array, open_arrays, save_meta, truncate
+from preprocessing import preprocess_many
+from store import ArticleStore, GET_ARTICLES_CHUNK_SIZE
+
+
+CORPUS_DIR = 'corpus'
+CORPUS_META_FN = 'corpus.json'
+CORPUS_LAYERS = ['tokens', 'tags', 'lemmas']
+# Sentence offsets index into the token arrays, document offsets into the sentence offsets
+CORPUS_ARRAYS = {'tokens': numpy.int32, 'tags': numpy.int32, 'lemmas': numpy.int32,
+                 'sent_offsets': numpy.int64, 'doc_offsets': numpy.int64, 'art_ids': numpy.int64}
+# Id used in the tag and lemma layers for articles that were not annotated
+MISSING_ID = -1
+
+
+def corpus_path(store_path):
+    return os.path.join(store_path, CORPUS_DIR)
+
+
+def _vocabulary_fn(path, layer):
+    return os.path.join(path, layer + '.vocab')
+
+
+def _array_lengths(meta):
+    return {'tokens': meta['n_tokens'], 'tags': meta['n_tokens'], 'lemmas': meta['n_tokens'],
+            'sent_offsets': meta['n_sents'] + 1, 'doc_offsets': meta['n_docs'] + 1, 'art_ids': meta['n_docs']}
+
+
+def _load_meta(path):
+    return load_meta(path, CORPUS_META_FN, {'n_tokens': 0, 'n_sents': 0, 'n_docs': 0,
+                                            'vocabularies': dict((layer, [0, 0]) for layer in CORPUS_LAYERS)})
+
+
+def _init_corpus_dir(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    init_offsets(path, ['sent_offsets', 'doc_offsets'], CORPUS_ARRAYS)
+
+
+class Vocabulary(object):
+    def __init__(self, fn, size=0, num_bytes=0):
+        self.fn = fn
+
+        self.ids = {}
+        self.words = []
+
+        self._committed_bytes = num_bytes
+        self._new_words = []
+
+        if size and os.path.exists(fn):
+            with open(fn, 'rb') as f:
+                for line in f:
+                    if len(self.words) >= size:
+                        break
+
+                    self.ids[line.rstrip('\n')] = len(self.words)
+                    self.words.append(line.rstrip('\n'))
+
+    def intern(self, word):
+        if isinstance(word, unicode):
+            word = word.encode('utf-8')
+
+        word_id = self.ids.get(word)
+
+        if word_id is None:
+            word_id = len(self.words)
+            self.ids[word] = word_id
+            self.words.append(word)
+            self._new_words.append(word)
+
+        return word_id
+
+    def encode(self, words):
+        return numpy.array([self.intern(word) for word in words], dtype=numpy.int32)
+
+    def decode(self, ids):
+        return [self.words[i] if i != MISSING_ID else None for i in ids]
+
+    def flush(self):
+        truncate(self.fn, self._committed_bytes)
+
+        with open(self.fn, 'ab') as f:
+            f.write(''.join(word + '\n' for word in self._new_words))
+
+        self._new_words = []
+        self._committed_bytes = os.path.getsize(self.fn)
+
+        return len(self.words), self._committed_bytes
+
+    def __getitem__(self, word_id):
+        return self.words[word_id]
+
+    def __len__(self):
+        return len(self.words)
+
+
+def _load_vocabularies(path, meta):
+    return dict((layer, Vocabulary(_vocabulary_fn(path, layer), *meta['vocabularies'][layer]))
+                for layer in CORPUS_LAYERS)
+
+
+def _annotated_layers(token):
+    # Tokens from preprocessing are plain strings, TreeTagger tokens are (word, tag, lemma)
+    if isinstance(token, tuple):
+        word, tag, lemma = token
+
+        return word, '_'.join(tag) if isinstance(tag, list) else tag, lemma
+    else:
+        return token, None, None
+
+
+class CorpusWriter(object):
+    def __init__(self, path):
+        self.path = path
+
+        _init_corpus_dir(path)
+
+        self.meta = _load_meta(path)
+        self.vocabularies = _load_vocabularies(path, self.meta)
+
+        self._files = None
+        self._art_ids = set(EncodedCorpus(path).art_ids.tolist())
+
+    def open(self):
+        self._files = open_arrays(self.path, CORPUS_ARRAYS, _array_lengths(self.meta))
+
+    def has_article(self, art_id):
+        return art_id in self._art_ids
+
+    def add(self, art_id, sentences):
+        if self._files is None:
+            self.open()
+
+        if art_id in self._art_ids:
+            return False
+
+        sent_ends = []
+        layers = dict((layer, []) for layer in CORPUS_LAYERS)
+        n_tokens = self.meta['n_tokens']
+
+        for sent in sentences:
+            for token in sent:
+                word, tag, lemma = _annotated_layers(token)
+
+                layers['tokens'].append(self.vocabularies['tokens'].intern(word))
+                layers['tags'].append(self.vocabularies['tags'].intern(tag) if tag is not None else MISSING_ID)
+                layers['lemmas'].append(self.vocabularies['lemmas'].intern(lemma) if lemma is not None else MISSING_ID)
+
+            n_tokens += len(sent)
+            sent_ends.append(n_tokens)
+
+        for layer in CORPUS_LAYERS:
+            numpy.array(layers[layer], dtype=CORPUS_ARRAYS[layer]).tofile(self._files[layer])
+
+        numpy.array(sent_ends, dtype=CORPUS_ARRAYS['sent_offsets']).tofile(self._files['sent_offsets'])
+
+        self.meta['n_tokens'] = n_tokens
+        self.meta['n_sents'] += len(sent_ends)
+        self.meta['n_docs'] += 1
+
+        numpy.array([self.meta['n_sents']], dtype=CORPUS_ARRAYS['doc_offsets']).tofile(self._files['doc_offsets'])
+        numpy.array([art_id], dtype=CORPUS_ARRAYS['art_ids']).tofile(self._files['art_ids'])
+
+        self._art_ids.add(art_id)
+
+        return True
+
+    def commit(self):
+        if self._files is not None:
+            for f in self._files.values():
+                f.flush()
+
+        for layer, vocabulary in self.vocabularies.items():
+            self.meta['vocabularies'][layer] = list(vocabulary.flush())
+
+        save_meta(self.path, CORPUS_META_FN, self.meta)
+
+    def close(self):
+        self.commit()
+
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+
+            self._files = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self._files is not None:
+            # Leave the last committed state in place
+            for f in self._files.values():
+                f.close()
+
+            self._files = None
+
+        return False
+
+
+class EncodedCorpus(object):
+    def __init__(self, path):
+        self.path = path
+
+        self.meta = _load_meta(path)
+        self.vocabularies = _load_vocabularies(path, self.meta)
+
+        self.arrays = dict((name, self._array(name)) for name in CORPUS_ARRAYS)
+        self.art_ids = self.arrays['art_ids']
+
+        self._index = None
+
+    def _array(self, name):
+        return map_array(self.path, name, CORPUS_ARRAYS[name], _array_lengths(self.meta)[name])
+
+    def _doc_indices(self):
+        if self._index is None:
+            self._index = dict((art_id, i) for i, art_id in enumerate(self.art_ids.tolist()))
+
+        return self._index
+
+    def _doc_index(self, art_id):
+        return self._doc_indices()[art_id]
+
+    def __len__(self):
+        return self.meta['n_docs']
+
+    def __contains__(self, art_id):
+        return art_id in self._doc_indices()
+
+    def _sentences(self, doc, layer):
+        doc_offsets = self.arrays['doc_offsets']
+        sent_offsets = self.arrays['sent_offsets']
+        ids = self.arrays[layer]
+
+        for sent in xrange(doc_offsets[doc], doc_offsets[doc + 1]):
+            # Slices of the memory mapped arrays, nothing is copied
+            yield ids[sent_offsets[sent]:sent_offsets[sent + 1]]
+
+    def sentences(self, art_id, layer='tokens'):
+        return self._sentences(self._doc_index(art_id), layer)
+
+    def tokens(self, art_id, layer='tokens'):
+        doc = self._doc_index(art_id)
+        start = self.arrays['sent_offsets'][self.arrays['doc_offsets'][doc]]
+        end = self.arrays['sent_offsets'][self.arrays['doc_offsets'][doc + 1]]
+
+        return self.arrays[layer][start:end]
+
+    def iter_sentences(self, layer='tokens'):
+        for doc in xrange(len(self)):
+            for sent in self._sentences(doc, layer):
+                yield sent
+
+    def decode(self, ids, layer='tokens'):
+        return self.vocabularies[layer].decode(ids)
+
+    def document(self, art_id, layer='tokens'):
+        # Same shape as preprocessing.preprocess output
+        return [self.decode(sent, layer) for sent in self.sentences(art_id, layer)]
+
+    def iter_documents(self, layer='tokens'):
+        for doc in xrange(len(self)):
+            yield [self.decode(sent, layer) for sent in self._sentences(doc, layer)]
+
+
+def _store_articles(store, art_ids, chunk_size):
+    for start in xrange(0, len(art_ids), chunk_size):
+        for article in store.get_articles(art_ids[start:start + chunk_size], fields=['cooked_doc']):
+            yield article
+
+
+def _annotate_many(store, texts, chunk_size):
+    cache = store.annotation_cache()
+
+    for chunk in iter(lambda: list(islice(texts, chunk_size)), []):
+        for doc in cache.annotate('treetagger', chunk):
+            yield doc
+
+
+def update_corpus(store, path, n_jobs=1, annotate=False, chunk_size=GET_ARTICLES_CHUNK_SIZE):
+    with CorpusWriter(path) as writer:
+        art_ids = [art_id for art_id in store.article_ids() if not writer.has_article(art_id)]
+        # Ids of the texts handed out for preprocessing, whose documents come back in the same order
+        pending = deque()
+
+        def texts():
+            for article in _store_articles(store, art_ids, chunk_size):
+                pending.append(article['art_id'])
+                yield article['cooked_doc']
+
+        if annotate:
+            docs = _annotate_many(store, texts(), chunk_size)
+        else:
+            # A single pool for the whole update, fed from the store as it goes
+            docs = preprocess_many(texts(), n_jobs=n_jobs)
+
+        for i, sentences in enumerate(docs, 1):
+            writer.add(pending.popleft(), sentences)
+
+            if i % chunk_size == 0:
+                writer.commit()
+
+    logging.info("Added %d articles to corpus in %s" % (len(art_ids), path))
+
+    return len(art_ids)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option('-s', '--store')
+    parser.add_option('-j', '--jobs', type=int, default=1)
+    parser.add_option('--annotate', action='store_true')
+
+    opts, args = parser.parse_args()
+
+    if opts.store:
+        store_path = os.path.abspath(opts.store)
+    else:
+        raise ValueError('--store argument is required')
+
+    with ArticleStore(store_path, index=False) as store:
+        update_corpus(store, corpus_path(store_path), opts.jobs, opts.annotate)
@@ -1,10 +1,38 @@
-import codecs
+from collections import Counter, deque
+from itertools import groupby
 import logging
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
 import re
+import time
+
+import numpy
+
+
+WORD_LINE_RE = re.compile(r'^"<(\S+)>"')
+TAG_LINE_RE = re.compile(r'^\t"\S+"')
+NER_TAG_RE = re.compile(r'&(pe|or|st|an|he|ve)\*')
+
+# In order of precedence when a line carries several NER tags
+NER_TAG_CODES = [('pe', 'PERSON'), ('or', 'ORG'), ('st', 'PLACE'), ('an', 'OTHER'), ('he', 'EVENT'), ('ve', 'WORK')]
+NER_TAGS = ['O'] + [tag for _, tag in NER_TAG_CODES]
+
+_NER_TAG_BY_CODE = dict(NER_TAG_CODES)
+_NER_TAG_PRECEDENCE = dict((code, i) for i, (code, _) in enumerate(NER_TAG_CODES))
+_NER_TAG_IDS = dict((tag, i) for i, tag in enumerate(NER_TAGS))
+
+NER_CORPORA = [('../ner/aviser-utf8.sy', '../ner/aviser-utf8.vrt'),
+               ('../ner/ukeblader-utf8.sy', '../ner/ukeblader-utf8.vrt'),
+               ('../ner/skj-litt-utf8.sy', '../ner/skj-litt-utf8.vrt')]
+
+CONVERT_CHUNK_SIZE = 8 * 1024 * 1024
+# Converted chunks waiting to be written, per worker process
+CONVERT_PREFETCH = 2
 
 
 def obt_word_line(line):
-    m = re.match('^"<(\S+)>"', line)
+    m = WORD_LINE_RE.match(line)
 
     if m:
         return m.group(1)
@@ -13,61 +41,268 @@ def obt_word_line(line):
 
 
 def obt_tag_line(line):
-    return re.match('^\t"\S+"', line)
+    return TAG_LINE_RE.match(line)
 
 
 def get_ner_tag(line):
-    if '&pe*' in line:
-        return 'PERSON'
-    elif '&or*' in line:
-        return 'ORG'
-    elif '&st*' in line:
-        return 'PLACE'
-    elif '&an*' in line:
-        return 'OTHER'
-    elif '&he*' in line:
-        return 'EVENT'
-    elif '&ve*' in line:
-        return 'WORK'
+    if '&' not in line:
+        return None
+
+    codes = NER_TAG_RE.findall(line)
+
+    if codes:
+        return _NER_TAG_BY_CODE[min(codes, key=_NER_TAG_PRECEDENCE.get)]
     else:
         return None
 
 
-def convert_ner_corpus(in_fn, out_fn):
-    with codecs.open(in_fn, 'r', 'utf-8') as in_f:
-        with codecs.open(out_fn, 'w', 'utf-8') as out_f:
-            cur_word = None
-            cur_tag = None
-            sent_end = None
+def _chunk_offsets(fn, chunk_size):
+    # Chunks start at the first word after a sentence end, so that every
+    # chunk can be converted on its own and the outputs concatenated.
+    size = os.path.getsize(fn)
+    offsets = [0]
+
+    with open(fn, 'rb') as f:
+        pos = chunk_size
+
+        while pos < size:
+            f.seek(pos)
+            f.readline()
+
+            boundary = size
+            sent_end = False
+
+            while True:
+                line_start = f.tell()
+                line = f.readline()
+
+                if not line:
+                    break
+                elif sent_end and line.startswith('"<'):
+                    boundary = line_start
+                    break
+                elif '<<<' in line and obt_tag_line(line):
+                    sent_end = True
+
+            if boundary >= size:
+                break
+
+            offsets.append(boundary)
+            pos = boundary + chunk_size
+
+    offsets.append(size)
+
+    return [(fn, start, end) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _convert_chunk(chunk):
+    fn, start, end = chunk
+
+    with open(fn, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    out = []
+    vocab = {}
+    token_ids = []
+    tag_ids = []
+    sent_lengths = []
+    inconsistent = Counter()
+
+    state = {'word': None, 'tag': None, 'sent_end': None, 'sent_len': 0}
+
+    def flush():
+        if state['word']:
+            out.append("%s\t%s\n" % (state['word'], state['tag'] or "O"))
+            token_ids.append(vocab.setdefault(state['word'], len(vocab)))
+            tag_ids.append(_NER_TAG_IDS[state['tag'] or "O"])
+            state['sent_len'] += 1
+
+        if state['sent_end']:
+            out.append('\n')
+            sent_lengths.append(state['sent_len'])
+            state['sent_len'] = 0
+
+    lines = data.split('\n')
+
+    # A single pass where the first characters decide the line type before any pattern is matched
+    for line in lines:
+        if line.startswith('"<'):
+            m = WORD_LINE_RE.match(line)
+
+            if m:
+                flush()
+
+                state['word'] = m.group(1)
+                state['tag'] = None
+                state['sent_end'] = None
+        elif line.startswith('\t"') and TAG_LINE_RE.match(line):
+            tag = get_ner_tag(line)
+            cur_tag = state['tag']
+
+            if tag and cur_tag and tag != cur_tag:
+                logging.debug("Inconsistent NER tags %s - %s for %s" % (tag, cur_tag, state['word']))
+                inconsistent[(tag, cur_tag)] += 1
+
+            if not cur_tag:
+                state['tag'] = tag
+
+            if '<<<' in line:
+                state['sent_end'] = True
+
+    # The last word of the input is written as well
+    flush()
+
+    if state['sent_len']:
+        sent_lengths.append(state['sent_len'])
+
+    words = sorted(vocab, key=vocab.get)
 
-            for line in in_f:
-                if obt_word_line(line):
-                    word = obt_word_line(line)
+    return {'text': ''.join(out), 'lines': len(lines), 'words': words,
+            'tokens': numpy.array(token_ids, dtype=numpy.int32), 'tags': numpy.array(tag_ids, dtype=numpy.int8),
+            'sent_lengths': numpy.array(sent_lengths, dtype=numpy.int64), 'inconsistent': inconsistent}
 
-                    if cur_word:
-                        out_f.write("%s\t%s\n" % (cur_word, cur_tag or "O"))
 
-                    if sent_end:
-                        out_f.write('\n')
+class _BinaryCorpusWriter(object):
+    def __init__(self, fn):
+        self.fn = fn
 
-                    cur_word = word
-                    cur_tag = None
-                    sent_end = None
+        self.vocab = {}
+        self.tokens = []
+        self.tags = []
+        self.sent_lengths = []
 
-                if obt_tag_line(line):
-                    tag = get_ner_tag(line)
+    def add(self, result):
+        # Chunk local token ids are mapped to corpus ids in one vectorized lookup
+        mapping = numpy.array([self.vocab.setdefault(word, len(self.vocab)) for word in result['words']],
+                              dtype=numpy.int32)
 
-                    if tag and cur_tag and tag != cur_tag:
-                        logging.warn("Inconsistent NER tags %s - %s for %s" % (tag, cur_tag, cur_word))
+        self.tokens.append(mapping[result['tokens']])
+        self.tags.append(result['tags'])
+        self.sent_lengths.append(result['sent_lengths'])
 
-                    if not cur_tag:
-                        cur_tag = tag
+    def close(self):
+        words = sorted(self.vocab, key=self.vocab.get)
+        sent_lengths = numpy.concatenate(self.sent_lengths or [numpy.zeros(0, dtype=numpy.int64)])
 
-                    if '<<<' in line:
-                        sent_end = True
+        numpy.savez(self.fn,
+                    tokens=numpy.concatenate(self.tokens or [numpy.zeros(0, dtype=numpy.int32)]),
+                    tags=numpy.concatenate(self.tags or [numpy.zeros(0, dtype=numpy.int8)]),
+                    sentence_offsets=numpy.concatenate([[0], numpy.cumsum(sent_lengths)]).astype(numpy.int64),
+                    vocabulary=numpy.frombuffer('\n'.join(words), dtype=numpy.uint8),
+                    tag_names=numpy.array(NER_TAGS))
+
+
+def load_binary_corpus(fn):
+    data = numpy.load(fn)
+    words = data['vocabulary'].tostring()
+
+    return {'tokens': data['tokens'], 'tags': data['tags'], 'sentence_offsets': data['sentence_offsets'],
+            'vocabulary': words.split('\n') if words else [], 'tag_names': list(data['tag_names'])}
+
+
+def binary_corpus_fn(out_fn):
+    return os.path.splitext(out_fn)[0] + '.npz'
+
+
+def _write_corpus(out_fn, results, binary_fn):
+    stats = {'lines': 0, 'words': 0, 'sentences': 0, 'inconsistent': Counter()}
+    writer = _BinaryCorpusWriter(binary_fn) if binary_fn else None
+
+    with open(out_fn, 'wb') as out_f:
+        for result in results:
+            out_f.write(result['text'])
+
+            if writer:
+                writer.add(result)
+
+            stats['lines'] += result['lines']
+            stats['words'] += len(result['tokens'])
+            stats['sentences'] += len(result['sent_lengths'])
+            stats['inconsistent'].update(result['inconsistent'])
+
+    if writer:
+        writer.close()
+
+    return stats
+
+
+def _log_stats(in_fn, stats, elapsed):
+    logging.info("Converted %s: %d lines, %d words, %d sentences in %.1fs (%.0f lines/s)" %
+                 (in_fn, stats['lines'], stats['words'], stats['sentences'], elapsed,
+                  stats['lines'] / max(elapsed, 1e-6)))
+
+    if stats['inconsistent']:
+        logging.warn("%d inconsistent NER tags in %s: %s" %
+                     (sum(stats['inconsistent'].values()), in_fn,
+                      ', '.join("%s - %s: %d" % (tag, prev_tag, count)
+                                for (tag, prev_tag), count in stats['inconsistent'].most_common())))
+
+
+def _converted_chunks(corpora, pool, processes, chunk_size, started):
+    # Converted chunks of all corpora in input order, tagged with the corpus index. Only a few chunks
+    # per process are converted ahead of the writer, so that the pool moves on to the next corpus
+    # without the output of later corpora piling up in memory.
+    pending = deque()
+
+    for i, (in_fn, _) in enumerate(corpora):
+        for chunk in _chunk_offsets(in_fn, chunk_size):
+            started.setdefault(i, time.time())
+
+            if pool is None:
+                yield i, _convert_chunk(chunk)
+                continue
+
+            pending.append((i, pool.apply_async(_convert_chunk, (chunk, ))))
+
+            if len(pending) >= processes * CONVERT_PREFETCH:
+                corpus, result = pending.popleft()
+                yield corpus, result.get()
+
+    while pending:
+        corpus, result = pending.popleft()
+        yield corpus, result.get()
+
+
+def convert_ner_corpora(corpora, processes=1, binary=False, chunk_size=CONVERT_CHUNK_SIZE):
+    pool = Pool(processes) if processes > 1 else None
+
+    try:
+        # Each corpus is timed from the submission of its first chunk
+        started = {}
+        all_stats = []
+
+        for i, results in groupby(_converted_chunks(corpora, pool, processes, chunk_size, started),
+                                  key=lambda item: item[0]):
+            in_fn, out_fn = corpora[i]
+            binary_fn = binary_corpus_fn(out_fn) if binary else None
+
+            stats = _write_corpus(out_fn, (result for _, result in results), binary_fn)
+            _log_stats(in_fn, stats, time.time() - started[i])
+
+            all_stats.append(stats)
+
+        return all_stats
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def convert_ner_corpus(in_fn, out_fn, processes=1, binary=False, chunk_size=CONVERT_CHUNK_SIZE):
+    return convert_ner_corpora([(in_fn, out_fn)], processes, binary, chunk_size)[0]
 
 
 if __name__ == '__main__':
-    convert_ner_corpus('../ner/aviser-utf8.sy', '../ner/aviser-utf8.vrt')
-    convert_ner_corpus('../ner/ukeblader-utf8.sy', '../ner/ukeblader-utf8.vrt')
-    convert_ner_corpus('../ner/skj-litt-utf8.sy', '../ner/skj-litt-utf8.vrt')
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option('-p', '--num-processes', type=int, default=1)
+    parser.add_option('--binary', action='store_true')
+    parser.add_option('--chunk-size', type=int, default=CONVERT_CHUNK_SIZE)
+
+    opts, args = parser.parse_args()
+
+    # Pairs of input and output files on the command line, the OBT corpora by default
+    corpora = zip(args[::2], args[1::2]) if args else NER_CORPORA
+
+    convert_ner_corpora(corpora, opts.num_processes, opts.binary, opts.chunk_size)
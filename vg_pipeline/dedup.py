@@ -0,0 +1,262 @@
+import hashlib
+import logging
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
+import re
+import struct
+import zlib
+
+import numpy
+
+from store import ArticleStore, GET_ARTICLES_CHUNK_SIZE
+
+
+SHINGLE_SIZE = 5
+NUM_PERM = 128
+LSH_BANDS = 16
+LSH_ROWS = 8
+DUPLICATE_THRESHOLD = 0.8
+MINHASH_SEED = 1
+
+MINHASH_PRIME = (1 << 61) - 1
+# Coefficients stay below 2^31 and shingle hashes below 2^32, so a * x + b never overflows 64 bits
+MINHASH_MAX_COEF = 1 << 31
+SHINGLE_HASH_MULT = numpy.uint64(1000003)
+
+# Band index in the top bits, bucket hash below
+LSH_BUCKET_BITS = 56
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _permutations(num_perm, seed):
+    random = numpy.random.RandomState(seed)
+
+    a = random.randint(1, MINHASH_MAX_COEF, size=num_perm).astype(numpy.uint64)
+    b = random.randint(0, MINHASH_MAX_COEF, size=num_perm).astype(numpy.uint64)
+
+    return a, b
+
+
+def shingle_hashes(text, shingle_size=SHINGLE_SIZE):
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+
+    words = WORD_RE.findall((text or u'').lower())
+
+    if not words:
+        return numpy.zeros(0, dtype=numpy.uint64)
+
+    # crc32 is stable across processes, unlike hash()
+    word_hashes = numpy.array([zlib.crc32(word.encode('utf-8')) & 0xffffffff for word in words], dtype=numpy.uint64)
+
+    size = min(shingle_size, len(words))
+    n_shingles = len(words) - size + 1
+
+    # Polynomial rolling combination of the word hashes in each window, one vector operation per position
+    hashes = numpy.zeros(n_shingles, dtype=numpy.uint64)
+
+    for i in xrange(size):
+        hashes = hashes * SHINGLE_HASH_MULT + word_hashes[i:i + n_shingles]
+
+    return numpy.unique((hashes ^ (hashes >> numpy.uint64(32))) & numpy.uint64(0xffffffff))
+
+
+def minhash(shingles, a, b):
+    # Texts without words have no signature, they would all look identical
+    if len(shingles) == 0:
+        return None
+
+    return ((a[:, None] * shingles[None, :] + b[:, None]) % numpy.uint64(MINHASH_PRIME)).min(axis=1)
+
+
+def band_keys(signature, bands=LSH_BANDS, rows=LSH_ROWS):
+    keys = []
+
+    for band in xrange(bands):
+        digest = hashlib.md5(signature[band * rows:(band + 1) * rows].tostring()).digest()
+        bucket = struct.unpack('<Q', digest[:8])[0] & ((1 << LSH_BUCKET_BITS) - 1)
+
+        keys.append((band << LSH_BUCKET_BITS) | bucket)
+
+    return keys
+
+
+def similarity(signature, other):
+    return float(numpy.mean(signature == other))
+
+
+class DedupIndex(object):
+    def __init__(self, store, threshold=DUPLICATE_THRESHOLD, num_perm=NUM_PERM, bands=LSH_BANDS, rows=LSH_ROWS,
+                 shingle_size=SHINGLE_SIZE, seed=MINHASH_SEED):
+        if bands * rows > num_perm:
+            raise ValueError("%d bands of %d rows need more than %d permutations" % (bands, rows, num_perm))
+
+        self.store = store
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.shingle_size = shingle_size
+
+        self._a, self._b = _permutations(num_perm, seed)
+
+    def signature(self, text):
+        return minhash(shingle_hashes(text, self.shingle_size), self._a, self._b)
+
+    def query(self, signature, exclude=None):
+        if signature is None:
+            return []
+
+        candidates = self.store.lsh_candidates(band_keys(signature, self.bands, self.rows))
+        candidates.discard(exclude)
+
+        matches = []
+
+        for art_id, other in self.store.get_minhashes(candidates).items():
+            score = similarity(signature, numpy.frombuffer(other, dtype=numpy.uint64))
+
+            if score >= self.threshold:
+                matches.append((art_id, score))
+
+        return sorted(matches, key=lambda match: -match[1])
+
+    def add(self, art_id, signature, commit=True):
+        # Articles without an id or without text can not be matched later
+        if art_id is None or signature is None:
+            return
+
+        self.store.put_minhash(art_id, signature.astype(numpy.uint64).tostring(),
+                               band_keys(signature, self.bands, self.rows), commit)
+
+    def check(self, art_id, text, commit=True):
+        # Returns the signature for a later add, and the closest earlier article if this one is a near duplicate.
+        # Texts without words get neither.
+        signature = self.signature(text)
+        matches = self.query(signature, exclude=art_id)
+
+        if not matches:
+            return signature, None
+
+        duplicate_of, score = matches[0]
+
+        if art_id is not None:
+            self.store.put_near_duplicate(art_id, duplicate_of, score, commit)
+
+        logging.info("Article %s is a near duplicate of %d (similarity %.2f)" % (art_id, duplicate_of, score))
+
+        return signature, duplicate_of
+
+    def filter_entries(self, entries):
+        # Drops feed entries already recognized as near duplicates so that they are not fetched again
+        known = self.store.near_duplicate_ids(entrydata['art_id'] for entrydata in entries)
+
+        return [entrydata for entrydata in entries if entrydata['art_id'] not in known]
+
+
+def _signatures(args):
+    articles, num_perm, shingle_size, seed = args
+    a, b = _permutations(num_perm, seed)
+
+    return [(art_id, minhash(shingle_hashes(text, shingle_size), a, b)) for art_id, text in articles]
+
+
+def index_archive(store, index, processes=1, num_perm=NUM_PERM, seed=MINHASH_SEED,
+                  chunk_size=GET_ARTICLES_CHUNK_SIZE):
+    indexed = store.minhash_art_ids()
+    art_ids = [art_id for art_id in store.article_ids() if art_id not in indexed]
+
+    def chunks():
+        for start in xrange(0, len(art_ids), chunk_size):
+            articles = store.get_articles(art_ids[start:start + chunk_size], fields=['cooked_doc'])
+
+            yield [(article['art_id'], article['cooked_doc']) for article in articles], num_perm, \
+                index.shingle_size, seed
+
+    pool = Pool(processes) if processes > 1 else None
+
+    try:
+        results = pool.imap(_signatures, chunks()) if pool else (_signatures(chunk) for chunk in chunks())
+
+        for signatures in results:
+            for art_id, signature in signatures:
+                index.add(art_id, signature, commit=False)
+
+            store.commit()
+    finally:
+        if pool:
+            pool.terminate()
+
+    logging.info("Computed MinHash signatures for %d articles" % len(art_ids))
+
+    return len(art_ids)
+
+
+def _find(parents, x):
+    while parents.get(x, x) != x:
+        parents[x] = parents.get(parents[x], parents[x])
+        x = parents[x]
+
+    return x
+
+
+def cluster_archive(store, index, processes=1, mark=False):
+    index_archive(store, index, processes)
+
+    parents = {}
+    art_ids = sorted(store.minhash_art_ids())
+
+    for start in xrange(0, len(art_ids), GET_ARTICLES_CHUNK_SIZE):
+        signatures = store.get_minhashes(art_ids[start:start + GET_ARTICLES_CHUNK_SIZE])
+
+        for art_id, signature in signatures.items():
+            for other_id, _ in index.query(numpy.frombuffer(signature, dtype=numpy.uint64), exclude=art_id):
+                root, other_root = _find(parents, art_id), _find(parents, other_id)
+
+                # The lowest art_id, normally the first published version, becomes the cluster root
+                if root != other_root:
+                    parents[max(root, other_root)] = min(root, other_root)
+
+    clusters = {}
+
+    for art_id in parents:
+        clusters.setdefault(_find(parents, art_id), set([_find(parents, art_id)])).add(art_id)
+
+    clusters = sorted(sorted(cluster) for cluster in clusters.values())
+
+    if mark:
+        for cluster in clusters:
+            original = cluster[0]
+            original_signature = numpy.frombuffer(store.get_minhashes([original])[original], dtype=numpy.uint64)
+
+            for art_id, signature in store.get_minhashes(cluster[1:]).items():
+                score = similarity(original_signature, numpy.frombuffer(signature, dtype=numpy.uint64))
+                store.put_near_duplicate(art_id, original, score, commit=False)
+
+        store.commit()
+
+    logging.info("Found %d near duplicate clusters covering %d articles" %
+                 (len(clusters), sum(len(cluster) for cluster in clusters)))
+
+    return clusters
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option('-s', '--store')
+    parser.add_option('-p', '--num-processes', type=int, default=1)
+    parser.add_option('-t', '--threshold', type=float, default=DUPLICATE_THRESHOLD)
+    parser.add_option('--mark', action='store_true')
+
+    opts, args = parser.parse_args()
+
+    if opts.store:
+        store_path = os.path.abspath(opts.store)
+    else:
+        raise ValueError('--store argument is required')
+
+    with ArticleStore(store_path, index=False) as store:
+        for cluster in cluster_archive(store, DedupIndex(store, opts.threshold), opts.num_processes, opts.mark):
+            logging.info("Cluster: %s" % ' '.join(str(art_id) for art_id in cluster))
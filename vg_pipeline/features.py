@@ -0,0 +1,222 @@
+from collections import Counter
+import logging
+from optparse import OptionParser
+import os
+
+import numpy
+from scipy.sparse import csr_matrix
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.preprocessing import normalize
+
+from flat_arrays import init_offsets, load_meta, map_array, open_arrays, save_meta, truncate
+from store import ArticleStore, GET_ARTICLES_CHUNK_SIZE
+
+
+FEATURES_DIR = 'features'
+FEATURES_META_FN = 'features.json'
+FEATURES_VOCABULARY_FN = 'vocabulary.txt'
+FEATURES_ARRAYS = {'data': numpy.int32, 'indices': numpy.int32, 'indptr': numpy.int64, 'art_ids': numpy.int64}
+
+FEATURE_VECTORIZER_PARAMS = {'strip_accents': 'unicode', 'lowercase': True}
+
+
+def feature_store_path(store_path):
+    return os.path.join(store_path, FEATURES_DIR)
+
+
+def _array_lengths(meta):
+    return {'data': meta['nnz'], 'indices': meta['nnz'], 'indptr': meta['n_docs'] + 1, 'art_ids': meta['n_docs']}
+
+
+def _load_meta(path):
+    return load_meta(path, FEATURES_META_FN, {'n_docs': 0, 'nnz': 0, 'n_terms': 0, 'vocabulary_bytes': 0})
+
+
+def _load_vocabulary(path, n_terms):
+    fn = os.path.join(path, FEATURES_VOCABULARY_FN)
+    vocabulary = {}
+
+    if os.path.exists(fn):
+        with open(fn, 'rb') as f:
+            for i, line in enumerate(f):
+                if i >= n_terms:
+                    break
+
+                vocabulary[line.rstrip('\n').decode('utf-8')] = i
+
+    return vocabulary
+
+
+class FeatureStore(object):
+    def __init__(self, path):
+        self.path = path
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        init_offsets(path, ['indptr'], FEATURES_ARRAYS)
+
+        self.meta = _load_meta(path)
+        self.vocabulary = _load_vocabulary(path, self.meta['n_terms'])
+
+        self._analyzer = CountVectorizer(**FEATURE_VECTORIZER_PARAMS).build_analyzer()
+
+    def _array(self, name):
+        return map_array(self.path, name, FEATURES_ARRAYS[name], _array_lengths(self.meta)[name])
+
+    def art_ids(self):
+        return self._array('art_ids')
+
+    def __len__(self):
+        return self.meta['n_docs']
+
+    def _count(self, text, new_terms):
+        counts = Counter()
+
+        for token in self._analyzer(text or u''):
+            term_id = self.vocabulary.get(token)
+
+            if term_id is None:
+                term_id = len(self.vocabulary)
+                self.vocabulary[token] = term_id
+                new_terms.append(token)
+
+            counts[term_id] += 1
+
+        return sorted(counts.items())
+
+    def append(self, articles):
+        meta = dict(self.meta)
+
+        known = set(self.art_ids().tolist())
+        new_terms = []
+
+        files = open_arrays(self.path, FEATURES_ARRAYS, _array_lengths(meta))
+
+        try:
+            for article in articles:
+                if article['art_id'] in known:
+                    continue
+
+                known.add(article['art_id'])
+
+                counts = self._count(article['cooked_doc'], new_terms)
+                term_ids = [term_id for term_id, _ in counts]
+
+                numpy.array(term_ids, dtype=FEATURES_ARRAYS['indices']).tofile(files['indices'])
+                numpy.array([count for _, count in counts], dtype=FEATURES_ARRAYS['data']).tofile(files['data'])
+
+                meta['nnz'] += len(counts)
+                meta['n_docs'] += 1
+
+                numpy.array([meta['nnz']], dtype=FEATURES_ARRAYS['indptr']).tofile(files['indptr'])
+                numpy.array([article['art_id']], dtype=FEATURES_ARRAYS['art_ids']).tofile(files['art_ids'])
+        finally:
+            for f in files.values():
+                f.close()
+
+        vocabulary_fn = os.path.join(self.path, FEATURES_VOCABULARY_FN)
+        truncate(vocabulary_fn, meta['vocabulary_bytes'])
+
+        with open(vocabulary_fn, 'ab') as f:
+            f.write(''.join(term.encode('utf-8') + '\n' for term in new_terms))
+
+        meta['n_terms'] = len(self.vocabulary)
+        meta['vocabulary_bytes'] = os.path.getsize(vocabulary_fn)
+        save_meta(self.path, FEATURES_META_FN, meta)
+
+        added = meta['n_docs'] - self.meta['n_docs']
+        self.meta = meta
+
+        return added
+
+    def update(self, store, chunk_size=GET_ARTICLES_CHUNK_SIZE):
+        known = set(self.art_ids().tolist())
+        new_ids = sorted(art_id for art_id in store.article_ids() if art_id not in known)
+
+        def articles():
+            for start in xrange(0, len(new_ids), chunk_size):
+                for article in store.get_articles(new_ids[start:start + chunk_size], fields=['cooked_doc']):
+                    yield article
+
+        added = self.append(articles())
+
+        logging.info("Added %d articles to feature store in %s (%d terms)" % (added, self.path, len(self.vocabulary)))
+
+        return added
+
+    def matrix(self, art_ids=None):
+        matrix = csr_matrix((self._array('data'), self._array('indices'), self._array('indptr')),
+                            shape=(self.meta['n_docs'], self.meta['n_terms']), copy=False)
+
+        if art_ids is None:
+            return matrix
+
+        rows = dict((art_id, i) for i, art_id in enumerate(self.art_ids().tolist()))
+
+        return matrix[[rows[art_id] for art_id in art_ids]]
+
+    def vectorizer(self):
+        # Produces count rows in this store's column order from raw text, for models used outside the store
+        vect = CountVectorizer(vocabulary=self.vocabulary, **FEATURE_VECTORIZER_PARAMS)
+        vect.fit([])
+
+        return vect
+
+
+class CountTfidfTransformer(BaseEstimator, TransformerMixin):
+    # Document frequency filtering and IDF in one step, so that both are
+    # computed from the training fold only when used in cross validation.
+    def __init__(self, max_df=1.0, min_df=1, sublinear_tf=False, smooth_idf=True, norm='l2'):
+        self.max_df = max_df
+        self.min_df = min_df
+        self.sublinear_tf = sublinear_tf
+        self.smooth_idf = smooth_idf
+        self.norm = norm
+
+    def fit(self, X, y=None):
+        X = csr_matrix(X)
+        n_docs = X.shape[0]
+
+        df = numpy.bincount(X.indices, minlength=X.shape[1])
+
+        max_doc = self.max_df * n_docs if isinstance(self.max_df, float) else self.max_df
+        min_doc = self.min_df * n_docs if isinstance(self.min_df, float) else self.min_df
+
+        self.columns_ = numpy.flatnonzero((df >= min_doc) & (df <= max_doc))
+
+        smooth = int(self.smooth_idf)
+        self.idf_ = numpy.log(float(n_docs + smooth) / (df[self.columns_] + smooth)) + 1.0
+
+        return self
+
+    def transform(self, X):
+        X = csr_matrix(X)[:, self.columns_].astype(numpy.float64)
+
+        if self.sublinear_tf:
+            X.data = numpy.log(X.data) + 1.0
+
+        X.data *= self.idf_[X.indices]
+
+        if self.norm:
+            X = normalize(X, norm=self.norm, copy=False)
+
+        return X
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option('-s', '--store')
+
+    opts, args = parser.parse_args()
+
+    if opts.store:
+        store_path = os.path.abspath(opts.store)
+    else:
+        raise ValueError('--store argument is required')
+
+    with ArticleStore(store_path, index=False) as store:
+        FeatureStore(feature_store_path(store_path)).update(store)
@@ -0,0 +1,154 @@
+import httplib
+import logging
+import socket
+import threading
+import time
+import urlparse
+
+
+FETCH_TIMEOUT = 10
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.5
+FETCH_MAX_PER_HOST = 4
+FETCH_MAX_REDIRECTS = 5
+
+RETRY_STATUSES = {500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+
+USER_AGENT = 'vg-pipeline'
+
+
+class FetchError(IOError):
+    pass
+
+
+class HTTPFetcher(object):
+    def __init__(self, timeout=FETCH_TIMEOUT, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF,
+                 max_per_host=FETCH_MAX_PER_HOST):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_per_host = max_per_host
+
+        # Keep-alive connections are kept per thread and host, since
+        # httplib connections can not be shared between threads.
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._host_slots = {}
+        self._all_connections = []
+
+    def _connections(self):
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+
+        return self._local.connections
+
+    def _connection(self, scheme, netloc):
+        connections = self._connections()
+
+        if (scheme, netloc) not in connections:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+            connections[(scheme, netloc)] = conn
+
+            with self._lock:
+                self._all_connections.append(conn)
+
+        return connections[(scheme, netloc)]
+
+    def _drop_connection(self, scheme, netloc):
+        conn = self._connections().pop((scheme, netloc), None)
+
+        if conn:
+            conn.close()
+
+            with self._lock:
+                self._all_connections.remove(conn)
+
+    def _host_slot(self, netloc):
+        with self._lock:
+            if netloc not in self._host_slots:
+                self._host_slots[netloc] = threading.BoundedSemaphore(self.max_per_host)
+
+            return self._host_slots[netloc]
+
+    def _request(self, url, headers):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+
+        if parts.query:
+            path += '?' + parts.query
+
+        request_headers = {'User-Agent': USER_AGENT}
+        request_headers.update(headers or {})
+
+        with self._host_slot(parts.netloc):
+            reused = (parts.scheme, parts.netloc) in self._connections()
+            conn = self._connection(parts.scheme, parts.netloc)
+
+            try:
+                conn.request('GET', path, headers=request_headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                self._drop_connection(parts.scheme, parts.netloc)
+
+                if not reused:
+                    raise
+
+                # The server may have closed an idle keep-alive connection
+                conn = self._connection(parts.scheme, parts.netloc)
+                conn.request('GET', path, headers=request_headers)
+                response = conn.getresponse()
+                body = response.read()
+
+        if response.getheader('connection', '').lower() == 'close':
+            self._drop_connection(parts.scheme, parts.netloc)
+
+        return response.status, dict(response.getheaders()), body
+
+    def _fetch_once(self, url, headers):
+        for _ in xrange(FETCH_MAX_REDIRECTS + 1):
+            status, response_headers, body = self._request(url, headers)
+
+            if status in REDIRECT_STATUSES and 'location' in response_headers:
+                url = urlparse.urljoin(url, response_headers['location'])
+            else:
+                return status, response_headers, body
+
+        raise FetchError("Too many redirects for %s" % url)
+
+    def fetch(self, url, headers=None):
+        error = None
+
+        for attempt in xrange(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                status, response_headers, body = self._fetch_once(url, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                error = e
+                logging.warn("Fetching %s failed (attempt %d): %s" % (url, attempt + 1, e))
+                continue
+
+            if status in RETRY_STATUSES:
+                error = "HTTP status %d" % status
+                logging.warn("Fetching %s returned %d (attempt %d)" % (url, status, attempt + 1))
+                continue
+
+            return status, response_headers, body
+
+        raise FetchError("Fetching %s failed after %d attempts: %s" % (url, self.retries + 1, error))
+
+    def close(self):
+        with self._lock:
+            for conn in self._all_connections:
+                conn.close()
+
+            self._all_connections = []
+
+        self._local = threading.local()
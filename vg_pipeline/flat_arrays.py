@@ -0,0 +1,60 @@
+import json
+import os
+
+import numpy
+
+
+# Flat binary files that are only ever appended to, and read back memory mapped.
+# The json meta file holding their committed lengths is replaced last, so anything
+# written past those lengths by an interrupted append is ignored and later overwritten.
+
+
+def array_fn(path, name):
+    return os.path.join(path, name + '.bin')
+
+
+def load_meta(path, meta_fn, default):
+    fn = os.path.join(path, meta_fn)
+
+    if not os.path.exists(fn):
+        return default
+
+    with open(fn) as f:
+        return json.load(f)
+
+
+def save_meta(path, meta_fn, meta):
+    fn = os.path.join(path, meta_fn)
+
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(meta, f)
+
+    os.rename(fn + '.tmp', fn)
+
+
+def truncate(fn, size):
+    with open(fn, 'ab') as f:
+        f.truncate(size)
+
+
+def init_offsets(path, names, dtypes):
+    # Offset arrays start with a single 0
+    for name in names:
+        if not os.path.exists(array_fn(path, name)):
+            numpy.zeros(1, dtype=dtypes[name]).tofile(array_fn(path, name))
+
+
+def open_arrays(path, dtypes, lengths):
+    for name, dtype in dtypes.items():
+        truncate(array_fn(path, name), lengths[name] * numpy.dtype(dtype).itemsize)
+
+    return dict((name, open(array_fn(path, name), 'ab')) for name in dtypes)
+
+
+def map_array(path, name, dtype, length):
+    fn = array_fn(path, name)
+
+    if length == 0 or not os.path.exists(fn):
+        return numpy.zeros(length, dtype=dtype)
+
+    return numpy.memmap(fn, dtype=dtype, mode='r', shape=(length, ))
@@ -1,5 +1,9 @@
+from collections import OrderedDict
 import codecs
+import logging
 import os
+import threading
+import time
 
 import lucene
 
@@ -7,28 +11,39 @@ from org.apache.lucene.store import SimpleFSDirectory
 from org.apache.lucene.analysis.miscellaneous import LimitTokenCountAnalyzer
 from org.apache.lucene.util import Version
 from org.apache.lucene.analysis.standard import StandardAnalyzer
-from org.apache.lucene.index import FieldInfo, IndexWriter, IndexWriterConfig, DirectoryReader
+from org.apache.lucene.index import FieldInfo, IndexWriter, IndexWriterConfig, DirectoryReader, MultiFields, Term
 from org.apache.lucene.document import FieldType, Document, Field
-from org.apache.lucene.search import IndexSearcher
+from org.apache.lucene.search import IndexSearcher, SearcherManager
+from org.apache.lucene.search.highlight import Highlighter, QueryScorer, SimpleHTMLFormatter
 from org.apache.lucene.queryparser.classic import QueryParser
+from org.apache.lucene.util import BytesRefIterator
 from java.io import File
+from java.util import HashSet
 
 
-def get_writer(index='index'):
+SEARCH_CACHE_SIZE = 1000
+# Check the index for new commits at most this often (seconds)
+SEARCH_REFRESH_INTERVAL = 1.0
+
+
+def get_writer(index='index', create=False):
     store = SimpleFSDirectory(File(index))
 
     analyzer = StandardAnalyzer(Version.LUCENE_CURRENT)
     analyzer = LimitTokenCountAnalyzer(analyzer, 1048576)
 
     config = IndexWriterConfig(Version.LUCENE_CURRENT, analyzer)
-    config.setOpenMode(IndexWriterConfig.OpenMode.CREATE_OR_APPEND)
+    if create:
+        config.setOpenMode(IndexWriterConfig.OpenMode.CREATE)
+    else:
+        config.setOpenMode(IndexWriterConfig.OpenMode.CREATE_OR_APPEND)
 
     writer = IndexWriter(store, config)
 
     return writer
 
 
-def index_article(writer, art_id, art_body):
+def index_article(writer, art_id, art_body, update=False):
     art_id_field = FieldType()
     art_id_field.setIndexed(True)
     art_id_field.setStored(True)
@@ -45,7 +60,10 @@ def index_article(writer, art_id, art_body):
     doc.add(Field("art_id", str(art_id), art_id_field))
     doc.add(Field("art_body", art_body, art_body_field))
 
-    writer.addDocument(doc)
+    if update:
+        writer.updateDocument(Term("art_id", str(art_id)), doc)
+    else:
+        writer.addDocument(doc)
 
 
 def is_article_indexed(art_id, index='index'):
@@ -60,15 +78,48 @@ def is_article_indexed(art_id, index='index'):
     return len(docs) > 0
 
 
+def indexed_article_ids(index='index'):
+    store = SimpleFSDirectory(File(index))
+
+    if not DirectoryReader.indexExists(store):
+        return set()
+
+    reader = DirectoryReader.open(store)
+
+    try:
+        terms = MultiFields.getTerms(reader, 'art_id')
+
+        if terms is None:
+            return set()
+
+        return set(int(term.utf8ToString()) for term in BytesRefIterator.cast_(terms.iterator(None)))
+    finally:
+        reader.close()
+
+
 def init_lucene():
     lucene.initVM(vmargs=['-Djava.awt.headless=true'])
 
 
+def init_backend():
+    try:
+        init_lucene()
+    except ValueError:
+        # Lucene already initialized. Ignore exception.
+        pass
+
+
+def attach_thread():
+    # Every Python thread other than the one that started the JVM must be attached before calling into Lucene
+    lucene.getVMEnv().attachCurrentThread()
+
+
 def update_index(index_dir, stored_index):
     writer = get_writer(index_dir)
+    indexed = indexed_article_ids(index_dir)
 
     for art_id, raw_fn in stored_index.items():
-        if not is_article_indexed(art_id, index_dir):
+        if art_id not in indexed:
             art_path = os.path.dirname(raw_fn)
             cooked_fn = os.path.join(art_path, "%d-cooked.txt" % art_id)
 
@@ -92,4 +143,112 @@ def search(term, n_docs=10, index='index'):
 
     score_docs = searcher.search(query, n_docs).scoreDocs
 
-    return [(score_doc.score, unicode(searcher.doc(score_doc.doc).get('art_body'))) for score_doc in score_docs]
\ No newline at end of file
+    # Same (art_id, score) hits as the native term index
+    return [(int(searcher.doc(score_doc.doc, _field_set('art_id')).get('art_id')), score_doc.score)
+            for score_doc in score_docs]
+
+
+def _field_set(*fields):
+    result = HashSet()
+
+    for field in fields:
+        result.add(field)
+
+    return result
+
+
+class SearchService(object):
+    def __init__(self, index='index', cache_size=SEARCH_CACHE_SIZE, refresh_interval=SEARCH_REFRESH_INTERVAL):
+        self.index = index
+        self.cache_size = cache_size
+        self.refresh_interval = refresh_interval
+
+        self._analyzer = StandardAnalyzer(Version.LUCENE_CURRENT)
+        self._manager = SearcherManager(SimpleFSDirectory(File(index)), None)
+        self._last_refresh = time.time()
+
+        self._cache = OrderedDict()
+        self._cache_version = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and time.time() - self._last_refresh < self.refresh_interval:
+                return
+
+            self._last_refresh = time.time()
+
+        # Reopens the shared reader only if a new commit exists
+        self._manager.maybeRefresh()
+
+    def _search(self, searcher, term, n_docs, offset, snippets):
+        # QueryParser is not thread safe, so parse with a fresh one
+        query = QueryParser(Version.LUCENE_CURRENT, 'art_body', self._analyzer).parse(term)
+        score_docs = searcher.search(query, offset + n_docs).scoreDocs[offset:]
+
+        if snippets:
+            highlighter = Highlighter(SimpleHTMLFormatter(), QueryScorer(query))
+            fields = _field_set('art_id', 'art_body')
+        else:
+            fields = _field_set('art_id')
+
+        hits = []
+
+        for score_doc in score_docs:
+            doc = searcher.doc(score_doc.doc, fields)
+            hit = (int(doc.get('art_id')), score_doc.score)
+
+            if snippets:
+                hit += (unicode(highlighter.getBestFragment(self._analyzer, 'art_body', doc.get('art_body')) or ''), )
+
+            hits.append(hit)
+
+        return hits
+
+    def _cached_search(self, searcher, version, term, n_docs, offset, snippets):
+        key = (term, n_docs, offset, snippets)
+
+        with self._lock:
+            # Cached results are only valid for the commit they were computed on
+            if version != self._cache_version:
+                self._cache.clear()
+                self._cache_version = version
+
+            if key in self._cache:
+                hits = self._cache.pop(key)
+                self._cache[key] = hits
+
+                return hits
+
+        hits = self._search(searcher, term, n_docs, offset, snippets)
+
+        with self._lock:
+            if version == self._cache_version:
+                self._cache[key] = hits
+
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return hits
+
+    def search(self, term, n_docs=10, offset=0, snippets=False):
+        return self.search_many([term], n_docs, offset, snippets)[0]
+
+    def search_many(self, terms, n_docs=10, offset=0, snippets=False):
+        self.refresh()
+
+        # One searcher for the whole batch, so that all results come from the same commit
+        searcher = self._manager.acquire()
+
+        try:
+            version = DirectoryReader.cast_(searcher.getIndexReader()).getVersion()
+
+            return [self._cached_search(searcher, version, term, n_docs, offset, snippets) for term in terms]
+        finally:
+            self._manager.release(searcher)
+
+    def close(self):
+        self._manager.close()
+
+        with self._lock:
+            self._cache.clear()
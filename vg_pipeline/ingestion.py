@@ -1,13 +1,18 @@
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import re
-import urllib2
 
 import feedparser
 import justext
 
+from fetching import HTTPFetcher, FetchError
+
 
 HTTP_OK = 200
+HTTP_NOT_MODIFIED = 304
+
+FETCH_WORKERS = 1
 
 ingestion_dir = os.path.join(os.getcwd(), 'articles')
 
@@ -30,15 +35,46 @@ def metadata_from_rss_entry(feed_entry):
             'date': feed_entry.get('published')}
 
 
-def ingest_feed(feed_url, store):
-    logging.info("Ingesting feed from URL %s" % feed_url)
+def fetch_article_raw(fetcher, entrydata):
+    try:
+        status, headers, body = fetcher.fetch(entrydata['url'])
+    except FetchError as e:
+        logging.warn(str(e))
+        return None
 
-    if not os.path.exists(ingestion_dir):
-        os.makedirs(ingestion_dir)
+    if status != HTTP_OK:
+        logging.warn("Article URL %s returned code %d" % (entrydata['url'], status))
+        return None
 
-    read_art_ids = []
+    entrydata['raw_doc'] = body.decode('latin1')
+
+    return entrydata
+
+
+def fetch_article(fetcher, entrydata):
+    entrydata = fetch_article_raw(fetcher, entrydata)
+
+    if entrydata is None:
+        return None
+
+    entrydata['cooked_doc'] = extract_article_text(entrydata['raw_doc'])
 
-    feed_doc = feedparser.parse(feed_url)
+    return entrydata
+
+
+def url_entries(urls):
+    return [{'url': url, 'art_id': extract_article_id(url)} for url in urls]
+
+
+def feed_entries(feed_url, feed_state=None):
+    if feed_state is None:
+        feed_doc = feedparser.parse(feed_url)
+    else:
+        feed_doc = feedparser.parse(feed_url, etag=feed_state.get('etag'), modified=feed_state.get('modified'))
+
+        if feed_doc.get('status') == HTTP_NOT_MODIFIED:
+            logging.info("Feed %s not modified" % feed_url)
+            return []
 
     if feed_doc.has_key('status') and feed_doc['status'] != HTTP_OK:
         logging.error("RSS ingestion URL returned code %d" % feed_doc['status'])
@@ -47,6 +83,14 @@ def ingest_feed(feed_url, store):
         logging.error("No entries key in RSS parse")
         return None
 
+    # Only a complete fetch may replace the validators, otherwise the next poll would skip what was missed
+    if feed_state is not None and feed_doc.get('status', HTTP_OK) == HTTP_OK and not feed_doc.get('bozo'):
+        for key in ('etag', 'modified'):
+            if feed_doc.get(key):
+                feed_state[key] = feed_doc[key]
+
+    entries = []
+
     for feed_entry in feed_doc['entries']:
         entrydata = metadata_from_rss_entry(feed_entry)
 
@@ -57,23 +101,97 @@ def ingest_feed(feed_url, store):
             logging.warn("RSS entry with no link url")
             continue
 
-        if entrydata['art_id'] and store.has_article(entrydata['art_id']):
+        entries.append(entrydata)
+
+    return entries
+
+
+def new_entries(entries, store):
+    result = []
+    seen_art_ids = set()
+    missing_art_ids = store.missing_article_ids(entrydata['art_id'] for entrydata in entries)
+
+    for entrydata in entries:
+        if entrydata['art_id'] and (entrydata['art_id'] in seen_art_ids or
+                                    entrydata['art_id'] not in missing_art_ids):
             logging.info("Article id %d already in store" % entrydata['art_id'])
             continue
 
-        opener = urllib2.build_opener()
-        try:
-            f = opener.open(entrydata['url'])
-            entrydata['raw_doc'] = f.read().decode('latin1')
-            f.close()
-        except urllib2.HTTPError:
-            continue
+        seen_art_ids.add(entrydata['art_id'])
+        result.append(entrydata)
+
+    return result
+
+
+def ingest_feed(feed_url, store, workers=FETCH_WORKERS, fetcher=None, pipeline=None, conditional=False, dedup=None):
+    logging.info("Ingesting feed from URL %s" % feed_url)
+
+    if not os.path.exists(ingestion_dir):
+        os.makedirs(ingestion_dir)
+
+    feed_state = store.get_feed_state(feed_url) if conditional else None
+
+    entries = feed_entries(feed_url, feed_state)
+
+    if entries is None:
+        return None
+
+    entries = new_entries(entries, store)
+
+    if dedup:
+        entries = dedup.filter_entries(entries)
+
+    if pipeline:
+        read_art_ids = pipeline.run(entries)
+    else:
+        read_art_ids = _fetch_and_store(entries, store, workers, fetcher, dedup)
+
+    # Only remember the validators once the entries are safely stored
+    if conditional:
+        store.set_feed_state(feed_url, feed_state)
+
+    return read_art_ids
+
+
+def _fetch_and_store(entries, store, workers, fetcher, dedup=None):
+    read_art_ids = []
+
+    own_fetcher = fetcher is None
+
+    if own_fetcher:
+        fetcher = HTTPFetcher()
+
+    pool = ThreadPool(workers) if workers > 1 else None
+
+    try:
+        if pool:
+            fetched = pool.imap(lambda entry: fetch_article(fetcher, entry), entries)
+        else:
+            fetched = (fetch_article(fetcher, entry) for entry in entries)
+
+        for entrydata in fetched:
+            if entrydata is None:
+                continue
+
+            if dedup:
+                signature, duplicate_of = dedup.check(entrydata['art_id'], entrydata['cooked_doc'])
+
+                if duplicate_of is not None:
+                    continue
+
+            store.add_article(entrydata)
 
-        entrydata['cooked_doc'] = extract_article_text(entrydata['raw_doc'])
+            if dedup:
+                dedup.add(entrydata['art_id'], signature)
 
-        store.add_article(entrydata)
+            read_art_ids.append(entrydata['art_id'])
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
-        read_art_ids.append(entrydata['art_id'])
+        if own_fetcher:
+            fetcher.close()
 
     return read_art_ids
 
@@ -1,19 +1,79 @@
+import heapq
 import logging
 from optparse import OptionParser
 import os
 import time
 
-from ingestion import ingest_feed, feed_address_all
+from fetching import HTTPFetcher, FETCH_MAX_PER_HOST, FETCH_TIMEOUT
+from ingestion import ingest_feed, feed_address_all, FETCH_WORKERS
+from pipeline import IngestionPipeline, EXTRACT_PROCESSES
 from store import ArticleStore
 
 
 INGESTION_INTERVAL = 600
+MIN_INGESTION_INTERVAL = 60
+MAX_INGESTION_INTERVAL = 1800
+
+# Aim for this many new articles per poll, polling faster when more arrive
+TARGET_ARTICLES_PER_POLL = 2
+INTERVAL_BACKOFF = 1.5
+
+TOPIC_MODEL_UPDATE_INTERVAL = 3600
+
+
+class FeedSchedule(object):
+    def __init__(self, url, interval=INGESTION_INTERVAL, min_interval=MIN_INGESTION_INTERVAL,
+                 max_interval=MAX_INGESTION_INTERVAL):
+        self.url = url
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = self._clamp(interval)
+
+    def _clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def update(self, num_new):
+        if num_new:
+            # Move halfway towards the interval that would yield the target number of articles
+            target = self.interval * TARGET_ARTICLES_PER_POLL / float(num_new)
+            self.interval = self._clamp((self.interval + target) / 2.0)
+        else:
+            self.interval = self._clamp(self.interval * INTERVAL_BACKOFF)
+
+        return self.interval
+
+
+def load_schedule(store, url, min_interval, max_interval):
+    interval = store.get_feed_state(url).get('interval') or INGESTION_INTERVAL
+
+    return FeedSchedule(url, interval, min_interval, max_interval)
+
+
+def save_schedule(store, schedule):
+    feed_state = store.get_feed_state(schedule.url)
+    feed_state['interval'] = schedule.interval
+
+    store.set_feed_state(schedule.url, feed_state)
+
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
     parser = OptionParser()
     parser.add_option('-r', '--root')
+    parser.add_option('-f', '--feed', action='append')
+    parser.add_option('-w', '--fetch-workers', type='int', default=FETCH_WORKERS)
+    parser.add_option('--max-per-host', type='int', default=FETCH_MAX_PER_HOST)
+    parser.add_option('--timeout', type='float', default=FETCH_TIMEOUT)
+    parser.add_option('--pipeline', action='store_true')
+    parser.add_option('-p', '--extract-processes', type='int', default=EXTRACT_PROCESSES)
+    parser.add_option('--min-interval', type='float', default=MIN_INGESTION_INTERVAL)
+    parser.add_option('--max-interval', type='float', default=MAX_INGESTION_INTERVAL)
+    parser.add_option('--topic-model')
+    parser.add_option('--model')
+    parser.add_option('--topic-model-interval', type='float', default=TOPIC_MODEL_UPDATE_INTERVAL)
+    parser.add_option('--dedup', action='store_true')
+    parser.add_option('--dedup-threshold', type='float')
 
     opts, args = parser.parse_args()
 
@@ -22,11 +82,64 @@ if __name__ == '__main__':
     else:
         raise ValueError('--root option is required')
 
+    feeds = opts.feed or [feed_address_all]
+
     logging.info("Ingesting to store in %s" % store_root)
     store = ArticleStore(store_root)
 
+    fetcher = HTTPFetcher(timeout=opts.timeout, max_per_host=opts.max_per_host)
+
+    if opts.dedup:
+        # Imported on demand so that numpy is only needed when near duplicates are detected
+        from dedup import DedupIndex, DUPLICATE_THRESHOLD
+        dedup = DedupIndex(store, opts.dedup_threshold or DUPLICATE_THRESHOLD)
+    else:
+        dedup = None
+
+    if opts.pipeline:
+        pipeline = IngestionPipeline(store, fetch_workers=opts.fetch_workers,
+                                     extract_processes=opts.extract_processes, fetcher=fetcher, dedup=dedup)
+    else:
+        pipeline = None
+
+    if opts.model:
+        # Imported on demand so that scikit-learn is only needed when classifying
+        from prediction import Predictor, classify_new
+        predictor = Predictor(os.path.abspath(opts.model))
+    else:
+        predictor = None
+
+    schedules = [load_schedule(store, url, opts.min_interval, opts.max_interval) for url in feeds]
+    queue = [(time.time(), i) for i in xrange(len(schedules))]
+
+    last_topic_update = time.time()
+    pending_topic_update = False
+
     while True:
-        art_ids = ingest_feed(feed_address_all, store)
-        logging.info("Ingested %d articles" % len(art_ids))
+        next_poll, i = heapq.heappop(queue)
+        time.sleep(max(0, next_poll - time.time()))
+
+        schedule = schedules[i]
+
+        art_ids = ingest_feed(schedule.url, store, workers=opts.fetch_workers, fetcher=fetcher,
+                              pipeline=pipeline, conditional=True, dedup=dedup) or []
+        interval = schedule.update(len(art_ids))
+        save_schedule(store, schedule)
+
+        logging.info("Ingested %d articles from %s, next poll in %d seconds" % (len(art_ids), schedule.url, interval))
+
+        heapq.heappush(queue, (time.time() + interval, i))
+
+        if predictor and art_ids:
+            classify_new(store, predictor)
+
+        pending_topic_update = pending_topic_update or bool(art_ids)
+
+        if opts.topic_model and pending_topic_update and \
+                time.time() - last_topic_update >= opts.topic_model_interval:
+            # Imported on demand so that gensim is only needed when topic models are kept current
+            from topic_modelling import update_topic_model
+            update_topic_model(store, os.path.abspath(opts.topic_model))
 
-        time.sleep(INGESTION_INTERVAL)
+            last_topic_update = time.time()
+            pending_topic_update = False
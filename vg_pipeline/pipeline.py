@@ -0,0 +1,308 @@
+import logging
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
+import Queue
+import sys
+import threading
+import time
+
+from fetching import HTTPFetcher
+from ingestion import fetch_article_raw, extract_article_text, url_entries, new_entries
+from store import ArticleStore
+
+
+FETCH_WORKERS = 4
+EXTRACT_PROCESSES = 2
+STORE_BATCH_SIZE = 50
+QUEUE_SIZE = 100
+
+# Commit a partial store batch when no article arrived for this long
+STORE_IDLE_COMMIT = 1.0
+
+_STOP = object()
+
+
+class StageStats(object):
+    def __init__(self, name, queue):
+        self.name = name
+        self.queue = queue
+
+        self.processed = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+        self._lock = threading.Lock()
+
+    def start(self):
+        # Counts are per run, a pipeline is reused for every feed poll
+        with self._lock:
+            self.processed = 0
+            self.failed = 0
+
+        self.started = time.time()
+        self.finished = None
+
+    def finish(self):
+        self.finished = time.time()
+
+    def add(self, processed=0, failed=0):
+        with self._lock:
+            self.processed += processed
+            self.failed += failed
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def throughput(self):
+        if not self.started:
+            return 0.0
+
+        elapsed = (self.finished or time.time()) - self.started
+
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return "%s: %d processed, %d failed, queue depth %d, %.2f articles/s" % \
+               (self.name, self.processed, self.failed, self.queue_depth(), self.throughput())
+
+
+class IngestionPipeline(object):
+    def __init__(self, store, fetch_workers=FETCH_WORKERS, extract_processes=EXTRACT_PROCESSES,
+                 store_batch_size=STORE_BATCH_SIZE, queue_size=QUEUE_SIZE, fetcher=None, dedup=None):
+        self.store = store
+        self.dedup = dedup
+        self.fetch_workers = fetch_workers
+        self.extract_processes = extract_processes
+        self.store_batch_size = store_batch_size
+
+        self.fetcher = fetcher or HTTPFetcher()
+
+        self.fetch_queue = Queue.Queue(queue_size)
+        self.extract_queue = Queue.Queue(queue_size)
+        self.store_queue = Queue.Queue(queue_size)
+
+        self.stats = [StageStats('fetch', self.fetch_queue),
+                      StageStats('extract', self.extract_queue),
+                      StageStats('store', self.store_queue)]
+
+        # Start the process pool before any pipeline threads exist
+        self._pool = Pool(extract_processes)
+
+        self._errors = []
+        self._failed = threading.Event()
+        self._local = threading.local()
+
+    def _get(self, queue, timeout=None):
+        item = queue.get(timeout=timeout)
+
+        if item is _STOP:
+            self._local.stopped = True
+
+        return item
+
+    def _feed(self, entries):
+        for entrydata in entries:
+            if self._failed.is_set():
+                break
+
+            self.fetch_queue.put(entrydata)
+
+        for _ in xrange(self.fetch_workers):
+            self.fetch_queue.put(_STOP)
+
+    def _fetch(self):
+        stats = self.stats[0]
+
+        for entrydata in iter(lambda: self._get(self.fetch_queue), _STOP):
+            if self._failed.is_set():
+                stats.add(failed=1)
+                continue
+
+            entrydata = fetch_article_raw(self.fetcher, entrydata)
+
+            if entrydata is None:
+                stats.add(failed=1)
+            else:
+                stats.add(processed=1)
+                self.extract_queue.put(entrydata)
+
+    def _extract(self):
+        stats = self.stats[1]
+
+        for entrydata in iter(lambda: self._get(self.extract_queue), _STOP):
+            if self._failed.is_set():
+                stats.add(failed=1)
+                continue
+
+            try:
+                entrydata['cooked_doc'] = self._pool.apply(extract_article_text, (entrydata['raw_doc'], ))
+            except Exception as e:
+                logging.error("Text extraction failed for %s: %s" % (entrydata['url'], e))
+                stats.add(failed=1)
+                continue
+
+            stats.add(processed=1)
+            self.store_queue.put(entrydata)
+
+    def _store(self, read_art_ids):
+        stats = self.stats[2]
+
+        self.store.attach_thread()
+
+        with self.store.batch(self.store_batch_size) as batch:
+            pending = False
+
+            while True:
+                try:
+                    entrydata = self._get(self.store_queue, STORE_IDLE_COMMIT)
+                except Queue.Empty:
+                    if pending:
+                        batch.commit()
+                        pending = False
+
+                    continue
+
+                if entrydata is _STOP:
+                    break
+
+                if self.dedup:
+                    # Written on the store thread's connection, so committed together with the batch
+                    signature, duplicate_of = self.dedup.check(entrydata['art_id'], entrydata['cooked_doc'],
+                                                               commit=False)
+
+                    if duplicate_of is not None:
+                        pending = True
+                        continue
+
+                if batch.add(entrydata):
+                    if self.dedup:
+                        self.dedup.add(entrydata['art_id'], signature, commit=False)
+
+                    read_art_ids.append(entrydata['art_id'])
+                    stats.add(processed=1)
+                    pending = True
+                else:
+                    stats.add(failed=1)
+
+    def _run_stage(self, stats, target, queue, args):
+        self._local.stopped = False
+
+        try:
+            target(*args)
+        except Exception:
+            logging.exception("Pipeline stage %s failed" % stats.name)
+
+            self._errors.append(sys.exc_info())
+            self._failed.set()
+
+            # Keep taking from the input queue until this thread's stop marker,
+            # so that upstream stages never block on a full queue
+            while not self._local.stopped:
+                if self._get(queue) is not _STOP:
+                    stats.add(failed=1)
+
+    def _start_stage(self, stats, target, queue, count, args=()):
+        stats.start()
+
+        threads = [threading.Thread(target=self._run_stage, args=(stats, target, queue, args)) for _ in xrange(count)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        return threads
+
+    def _join(self, thread):
+        # Joining with a timeout keeps the main thread responsive to KeyboardInterrupt
+        while thread.is_alive():
+            thread.join(STORE_IDLE_COMMIT)
+
+    def _join_stage(self, stats, threads, next_queue, next_count):
+        for thread in threads:
+            self._join(thread)
+
+        stats.finish()
+
+        for _ in xrange(next_count):
+            next_queue.put(_STOP)
+
+    def run(self, entries):
+        read_art_ids = []
+
+        self._errors = []
+        self._failed.clear()
+
+        feeder = threading.Thread(target=self._feed, args=(entries, ))
+        feeder.daemon = True
+        feeder.start()
+
+        fetchers = self._start_stage(self.stats[0], self._fetch, self.fetch_queue, self.fetch_workers)
+        extractors = self._start_stage(self.stats[1], self._extract, self.extract_queue, self.extract_processes)
+        storer = self._start_stage(self.stats[2], self._store, self.store_queue, 1, (read_art_ids, ))
+
+        self._join(feeder)
+        self._join_stage(self.stats[0], fetchers, self.extract_queue, self.extract_processes)
+        self._join_stage(self.stats[1], extractors, self.store_queue, 1)
+        self._join_stage(self.stats[2], storer, None, 0)
+
+        for stats in self.stats:
+            logging.info(str(stats))
+
+        if self._errors:
+            exc_type, exc_value, exc_tb = self._errors[0]
+            raise exc_type, exc_value, exc_tb
+
+        return read_art_ids
+
+    def stage_stats(self):
+        return dict((stats.name, {'queue_depth': stats.queue_depth(), 'processed': stats.processed,
+                                  'failed': stats.failed, 'throughput': stats.throughput()})
+                    for stats in self.stats)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self.fetcher.close()
+
+
+def ingest_urls(urls, store, **kwargs):
+    pipeline = IngestionPipeline(store, **kwargs)
+
+    try:
+        return pipeline.run(new_entries(url_entries(urls), store))
+    finally:
+        pipeline.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option('-r', '--root')
+    parser.add_option('-u', '--url-file')
+    parser.add_option('-w', '--fetch-workers', type='int', default=FETCH_WORKERS)
+    parser.add_option('-p', '--extract-processes', type='int', default=EXTRACT_PROCESSES)
+    parser.add_option('-b', '--batch-size', type='int', default=STORE_BATCH_SIZE)
+
+    opts, args = parser.parse_args()
+
+    if opts.root:
+        store_root = os.path.abspath(opts.root)
+    else:
+        raise ValueError('--root option is required')
+
+    if opts.url_file:
+        with open(opts.url_file) as f:
+            urls = [line.strip() for line in f if line.strip()]
+    else:
+        raise ValueError('--url-file option is required')
+
+    logging.info("Backfilling %d URLs to store in %s" % (len(urls), store_root))
+
+    with ArticleStore(store_root) as store:
+        art_ids = ingest_urls(urls, store, fetch_workers=opts.fetch_workers,
+                              extract_processes=opts.extract_processes, store_batch_size=opts.batch_size)
+
+    logging.info("Ingested %d articles" % len(art_ids))
@@ -0,0 +1,141 @@
+from collections import deque
+import logging
+from multiprocessing import Pool
+from optparse import OptionParser
+import os
+
+from sklearn.externals import joblib
+
+from store import ArticleStore
+
+
+PREDICT_BATCH_SIZE = 500
+# Batches in flight per worker process
+PREDICT_PREFETCH = 2
+MODEL_MMAP_MODE = 'r'
+
+
+def convert_model(model_fn, converted_fn):
+    # Compressed dumps are decompressed in full on every load, uncompressed
+    # ones can be memory mapped and their arrays shared between processes.
+    joblib.dump(joblib.load(model_fn), converted_fn)
+
+    return converted_fn
+
+
+def _classes(model):
+    if hasattr(model, 'classes_'):
+        return model.classes_
+    else:
+        return model.steps[-1][1].classes_
+
+
+class Predictor(object):
+    def __init__(self, model_fn, name=None, mmap_mode=MODEL_MMAP_MODE):
+        self.model_fn = model_fn
+        self.name = name or os.path.splitext(os.path.basename(model_fn))[0]
+
+        self.model = joblib.load(model_fn, mmap_mode=mmap_mode)
+
+    def predict(self, texts):
+        if not hasattr(self.model, 'decision_function'):
+            return [(topic, None) for topic in self.model.predict(texts)]
+
+        classes = _classes(self.model)
+        scores = self.model.decision_function(texts)
+
+        if scores.ndim == 1:
+            return [(classes[int(score > 0)], abs(float(score))) for score in scores]
+        else:
+            return [(classes[i], float(row[i])) for i, row in zip(scores.argmax(axis=1), scores)]
+
+    def predict_batch(self, art_ids, texts):
+        return [(art_id, topic, score) for art_id, (topic, score) in zip(art_ids, self.predict(texts))]
+
+
+_predictor = None
+
+
+def _init_predict_worker(model_fn, name):
+    global _predictor
+
+    _predictor = Predictor(model_fn, name)
+
+
+def _predict_batch(batch):
+    return _predictor.predict_batch(*batch)
+
+
+def _article_batches(store, art_ids, batch_size):
+    for start in xrange(0, len(art_ids), batch_size):
+        articles = store.get_articles(art_ids[start:start + batch_size], fields=['cooked_doc'])
+
+        yield [article['art_id'] for article in articles], [article['cooked_doc'] for article in articles]
+
+
+def _predict_parallel(predictor, batches, n_jobs):
+    pool = Pool(n_jobs, initializer=_init_predict_worker, initargs=(predictor.model_fn, predictor.name))
+
+    try:
+        pending = deque()
+
+        for batch in batches:
+            pending.append(pool.apply_async(_predict_batch, (batch, )))
+
+            if len(pending) >= n_jobs * PREDICT_PREFETCH:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def classify_new(store, predictor, batch_size=PREDICT_BATCH_SIZE, n_jobs=1):
+    art_ids = store.unpredicted_article_ids(predictor.name)
+    batches = _article_batches(store, art_ids, batch_size)
+
+    if n_jobs == 1:
+        results = (predictor.predict_batch(*batch) for batch in batches)
+    else:
+        results = _predict_parallel(predictor, batches, n_jobs)
+
+    num_predicted = 0
+
+    for predictions in results:
+        store.put_predictions(predictor.name, predictions)
+        num_predicted += len(predictions)
+
+    logging.info("Classified %d articles with model %s" % (num_predicted, predictor.name))
+
+    return num_predicted
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option('-s', '--store')
+    parser.add_option('-m', '--model-file')
+    parser.add_option('-p', '--num-processes', type=int, default=1)
+    parser.add_option('-b', '--batch-size', type=int, default=PREDICT_BATCH_SIZE)
+    parser.add_option('--convert')
+
+    opts, args = parser.parse_args()
+
+    if opts.model_file:
+        model_fn = os.path.abspath(opts.model_file)
+        model_name = os.path.splitext(os.path.basename(model_fn))[0]
+    else:
+        raise ValueError('--model-file argument is required')
+
+    if opts.convert:
+        logging.info("Writing uncompressed model to %s" % opts.convert)
+
+        # Only the uncompressed copy can be memory mapped and shared by the workers,
+        # predictions are still stored under the name of the original model
+        model_fn = convert_model(model_fn, os.path.abspath(opts.convert))
+
+    if opts.store:
+        with ArticleStore(os.path.abspath(opts.store), index=False) as store:
+            classify_new(store, Predictor(model_fn, model_name), opts.batch_size, opts.num_processes)
@@ -1,12 +1,22 @@
+from collections import deque
 import cPickle
+from itertools import islice
+from multiprocessing import Pool
 import os
 
 from nltk import TreebankWordTokenizer
 
 
-NO_PUNKT_MODEL = os.path.join('models', 'punkt-norwegian-open2.pickle')
+# Made absolute on import so that pool workers do not depend on their working directory
+NO_PUNKT_MODEL = os.path.abspath(os.environ.get('VG_PUNKT_MODEL',
+                                                os.path.join('models', 'punkt-norwegian-open2.pickle')))
+
+PREPROCESS_CHUNK_SIZE = 100
+# Chunks in flight per worker, bounds memory use when preprocessing from an iterator
+PREPROCESS_PREFETCH = 2
 
 _punkt_tokenizer = None
+_word_tokenizer = TreebankWordTokenizer()
 
 
 def get_punkt_tokenizer():
@@ -28,8 +38,50 @@ def split_sentences(text):
 
 
 def tokenize(text):
-    return [token.encode('utf-8') for token in TreebankWordTokenizer().tokenize(text)]
+    tokens = _word_tokenizer.tokenize(text)
+
+    if not tokens:
+        return []
+
+    # Tokens never contain spaces, so the sentence is encoded in one go
+    return u' '.join(tokens).encode('utf-8').split(' ')
 
 
 def preprocess(text):
     return [tokenize(sent) for sent in split_sentences(text)]
+
+
+def _init_preprocess_worker():
+    get_punkt_tokenizer()
+
+
+def _preprocess_chunk(texts):
+    return [preprocess(text) for text in texts]
+
+
+def preprocess_many(texts, n_jobs=1, chunksize=PREPROCESS_CHUNK_SIZE):
+    texts = iter(texts)
+
+    if n_jobs == 1:
+        for text in texts:
+            yield preprocess(text)
+
+        return
+
+    pool = Pool(n_jobs, initializer=_init_preprocess_worker)
+
+    try:
+        pending = deque()
+
+        for chunk in iter(lambda: list(islice(texts, chunksize)), []):
+            pending.append(pool.apply_async(_preprocess_chunk, (chunk, )))
+
+            if len(pending) >= n_jobs * PREPROCESS_PREFETCH:
+                for result in pending.popleft().get():
+                    yield result
+
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+    finally:
+        pool.terminate()
@@ -1,18 +1,26 @@
 import logging
+from optparse import OptionParser
 import os
+import shutil
 import sqlite3
+import subprocess
+import sys
+import threading
+import zlib
 
-from indexing import init_lucene, get_writer, index_article
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
-SQL_SELECT_ART_ID = 'select art_id from content, metadata where content.id = metadata.content_id'
-SQL_SELECT_ART_ID_CONTENT_NOT_EMPTY = 'select art_id from content, metadata ' \
-                                      'where content.id = metadata.content_id and cooked != "" and art_id is not null'
 SQL_SELECT_ARTICLE_BY_ID = 'select art_id, cooked, summary, title, tags, date from metadata, content ' \
                            'where metadata.content_id = content.id and metadata.art_id = ?'
 SQL_INSERT_METADATA = 'insert into metadata (content_id, art_id, summary, title, tags, date) values (?, ?, ?, ?, ?, ?)'
 SQL_INSERT_CONTENT = 'insert into content (cooked, raw) values (?, ?)'
 SQL_HAS_ARTICLE = 'select art_id from metadata, content where metadata.content_id = content.id and metadata.art_id = ?'
+SQL_SELECT_KNOWN_ART_IDS = 'select art_id from metadata where art_id is not null'
+SQL_SELECT_EXISTING_ART_IDS = 'select art_id from metadata where art_id in (%s)'
 SQL_INDEX_CONTENT_ID = 'create unique index if not exists content_id on content (id)'
 SQL_INDEX_METADATA_ART_ID = 'create unique index if not exists metadata_art_id on metadata (art_id)'
 SQL_INDEX_METADATA_ID_ = 'create unique index if not exists metadata_id on metadata (id)'
@@ -22,87 +30,522 @@ SQL_TABLE_METADATA = 'create table if not exists metadata (id integer primary ke
                      'art_id integer, summary text, title text, tags text, date text, ' \
                      'foreign key (content_id) references content(id))'
 SQL_ARTICLE_COUNT = "select count() from content"
-
-TERM_INDEX_ROOT = 'term_index'
+SQL_SELECT_ARTICLES = 'select %s from metadata, content where metadata.content_id = content.id'
+SQL_FILTER_CONTENT_NOT_EMPTY = ' and cooked != "" and art_id is not null'
+SQL_FILTER_ART_ID_IN = ' and metadata.art_id in (%s)'
+SQL_FILTER_AFTER_ROW_ID = ' and metadata.id > ?'
+SQL_FILTER_TAGS_ANY = ' and metadata.art_id in (select art_id from article_tags where tag in (%s))'
+SQL_FILTER_TAGS_ALL = ' and metadata.art_id in (select art_id from article_tags where tag in (%s) ' \
+                      'group by art_id having count(distinct tag) = ?)'
+SQL_TABLE_ARTICLE_TAGS = 'create table if not exists article_tags (art_id integer, tag text)'
+SQL_INDEX_ARTICLE_TAGS_TAG = 'create index if not exists article_tags_tag on article_tags (tag, art_id)'
+SQL_INDEX_ARTICLE_TAGS_ART_ID = 'create index if not exists article_tags_art_id on article_tags (art_id)'
+SQL_INSERT_ARTICLE_TAG = 'insert into article_tags (art_id, tag) values (?, ?)'
+SQL_SELECT_METADATA_TAGS = 'select art_id, tags from metadata where art_id is not null'
+SQL_TAG_COUNTS = 'select tag, count() from article_tags group by tag'
+SQL_TABLE_RAW_CONTENT = 'create table if not exists raw_content (content_id integer primary key, codec text, ' \
+                        'dict_id integer, data blob, foreign key (content_id) references content(id))'
+SQL_TABLE_RAW_DICTS = 'create table if not exists raw_dicts (id integer primary key autoincrement, codec text, ' \
+                      'data blob)'
+SQL_INSERT_RAW_CONTENT = 'insert into raw_content (content_id, codec, dict_id, data) values (?, ?, ?, ?)'
+SQL_INSERT_RAW_DICT = 'insert into raw_dicts (codec, data) values (?, ?)'
+SQL_SELECT_RAW_DICT = 'select id, data from raw_dicts where codec = ? order by id desc limit 1'
+SQL_SELECT_RAW_DICT_BY_ID = 'select data from raw_dicts where id = ?'
+SQL_SELECT_RAW_DOC = 'select raw_content.codec, raw_content.dict_id, raw_content.data, content.raw ' \
+                     'from metadata join content on metadata.content_id = content.id ' \
+                     'left join raw_content on raw_content.content_id = content.id where metadata.art_id = ?'
+SQL_SELECT_UNMIGRATED_RAW_IDS = 'select id from content where raw is not null'
+SQL_SELECT_UNMIGRATED_RAW = 'select id, raw from content where id in (%s)'
+SQL_SAMPLE_UNMIGRATED_RAW = 'select raw from content where raw is not null order by random() limit ?'
+SQL_CLEAR_RAW = 'update content set raw = null where id in (%s)'
+SQL_PAGE_COUNT = 'pragma page_count'
+SQL_PAGE_SIZE = 'pragma page_size'
+SQL_VACUUM = 'vacuum'
+SQL_TABLE_FEED_STATE = 'create table if not exists feed_state (url text primary key, etag text, modified text, ' \
+                       'interval real)'
+SQL_SELECT_FEED_STATE = 'select etag, modified, interval from feed_state where url = ?'
+SQL_REPLACE_FEED_STATE = 'insert or replace into feed_state (url, etag, modified, interval) values (?, ?, ?, ?)'
+SQL_TABLE_WATERMARKS = 'create table if not exists watermarks (name text primary key, value integer)'
+SQL_SELECT_WATERMARK = 'select value from watermarks where name = ?'
+SQL_REPLACE_WATERMARK = 'insert or replace into watermarks (name, value) values (?, ?)'
+SQL_TABLE_PREDICTIONS = 'create table if not exists predictions (art_id integer, model text, topic text, ' \
+                        'score real, primary key (art_id, model))'
+SQL_REPLACE_PREDICTION = 'insert or replace into predictions (art_id, model, topic, score) values (?, ?, ?, ?)'
+SQL_SELECT_UNPREDICTED_ART_IDS = 'select metadata.art_id from metadata, content ' \
+                                 'where metadata.content_id = content.id' + SQL_FILTER_CONTENT_NOT_EMPTY + \
+                                 ' and metadata.art_id not in (select art_id from predictions where model = ?)'
+SQL_SELECT_PREDICTIONS = 'select art_id, topic, score from predictions where model = ? and art_id in (%s)'
+SQL_TABLE_MINHASH = 'create table if not exists minhash (art_id integer primary key, signature blob)'
+SQL_TABLE_LSH_BANDS = 'create table if not exists lsh_bands (key integer, art_id integer)'
+SQL_INDEX_LSH_BANDS_KEY = 'create index if not exists lsh_bands_key on lsh_bands (key)'
+SQL_TABLE_NEAR_DUPLICATES = 'create table if not exists near_duplicates (art_id integer primary key, ' \
+                            'duplicate_of integer, similarity real)'
+SQL_REPLACE_MINHASH = 'insert or replace into minhash (art_id, signature) values (?, ?)'
+SQL_DELETE_LSH_BANDS = 'delete from lsh_bands where art_id = ?'
+SQL_INSERT_LSH_BAND = 'insert into lsh_bands (key, art_id) values (?, ?)'
+SQL_SELECT_LSH_CANDIDATES = 'select distinct art_id from lsh_bands where key in (%s)'
+SQL_SELECT_MINHASHES = 'select art_id, signature from minhash where art_id in (%s)'
+SQL_SELECT_MINHASH_ART_IDS = 'select art_id from minhash'
+SQL_REPLACE_NEAR_DUPLICATE = 'insert or replace into near_duplicates (art_id, duplicate_of, similarity) ' \
+                             'values (?, ?, ?)'
+SQL_SELECT_NEAR_DUPLICATE_IDS = 'select art_id from near_duplicates where art_id in (%s)'
+SQL_GET_SCHEMA_VERSION = 'pragma user_version'
+SQL_SET_SCHEMA_VERSION = 'pragma user_version = %d'
+SQL_BEGIN_IMMEDIATE = 'begin immediate'
+SQL_COMMIT = 'commit'
+SQL_ROLLBACK = 'rollback'
+
+ARTICLE_COLUMNS = {'art_id': 'metadata.art_id', 'cooked_doc': 'content.cooked', 'summary': 'metadata.summary',
+                   'title': 'metadata.title', 'tags': 'metadata.tags', 'date': 'metadata.date',
+                   'row_id': 'metadata.id'}
+ARTICLE_FIELDS = ['art_id', 'cooked_doc', 'summary', 'title', 'tags', 'date']
+
+TERM_INDEX_BACKEND = 'lucene'
+TERM_INDEX_ROOTS = {'lucene': 'term_index', 'native': 'term_index_native'}
+REBUILD_THREADS = 4
+REINDEX_BATCH_SIZE = 500
+
+STARTUP_BENCHMARK_RUNS = 5
+STARTUP_BENCHMARK_SCRIPT = 'import sys, time\n' \
+                           't = time.time()\n' \
+                           'from store import ArticleStore\n' \
+                           'mode = sys.argv[3]\n' \
+                           'store = ArticleStore(sys.argv[1], index_backend=sys.argv[2], index=mode != "none")\n' \
+                           'if mode == "eager":\n' \
+                           '    store.term_index()\n' \
+                           'len(store)\n' \
+                           'print time.time() - t\n'
 
 STORE_DB_FN = 'store.db'
 
+BATCH_COMMIT_INTERVAL = 1000
+
+ITER_BATCH_SIZE = 1000
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER (999) for IN (...) lookups
+GET_ARTICLES_CHUNK_SIZE = 500
+
+RAW_CODEC = 'zlib'
+RAW_ZLIB_LEVEL = 6
+RAW_ZSTD_LEVEL = 19
+RAW_DICT_SIZE = 112640
+RAW_DICT_SAMPLES = 2000
+RAW_MIGRATION_CHUNK_SIZE = 500
+
+SQLITE_TIMEOUT = 30.0
+SQLITE_CACHED_STATEMENTS = 256
+SQLITE_PRAGMAS = [('journal_mode', 'wal'),
+                  ('synchronous', 'normal'),
+                  ('cache_size', -65536),
+                  ('mmap_size', 268435456)]
+
 
 def _store_db_fn(path):
     return os.path.join(path, STORE_DB_FN)
 
 
-def _init_store_db(path):
-    conn = _db_conn(path)
+def _article_tags(tags):
+    return set(tag for tag in tags if tag)
+
+
+def _migrate_article_tags(conn):
+    cur = conn.cursor()
+
+    rows = [(art_id, tag) for art_id, tags in cur.execute(SQL_SELECT_METADATA_TAGS).fetchall()
+            for tag in _article_tags((tags or '').split('|'))]
+    cur.executemany(SQL_INSERT_ARTICLE_TAG, rows)
+
+    logging.info("Migrated %d article tags to article_tags table" % len(rows))
+
+
+SCHEMA_MIGRATIONS = [(1, _migrate_article_tags)]
+
+
+def _migrate_store_db(conn):
+    if conn.execute(SQL_GET_SCHEMA_VERSION).fetchone()[0] >= SCHEMA_MIGRATIONS[-1][0]:
+        return
+
+    # Managed by hand, the sqlite3 module would commit before the pragmas and end the transaction early
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+
+    try:
+        # Takes the write lock before the version is read again, so that a store opened
+        # by several processes at once is migrated by exactly one of them
+        conn.execute(SQL_BEGIN_IMMEDIATE)
+
+        try:
+            version = conn.execute(SQL_GET_SCHEMA_VERSION).fetchone()[0]
+
+            for migration_version, migration in SCHEMA_MIGRATIONS:
+                if version < migration_version:
+                    migration(conn)
+                    conn.execute(SQL_SET_SCHEMA_VERSION % migration_version)
 
+            conn.execute(SQL_COMMIT)
+        except Exception:
+            conn.execute(SQL_ROLLBACK)
+            raise
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def _init_store_db(conn):
     conn.execute(SQL_TABLE_CONTENT)
     conn.execute(SQL_TABLE_METADATA)
+    conn.execute(SQL_TABLE_ARTICLE_TAGS)
+    conn.execute(SQL_TABLE_RAW_CONTENT)
+    conn.execute(SQL_TABLE_RAW_DICTS)
+    conn.execute(SQL_TABLE_FEED_STATE)
+    conn.execute(SQL_TABLE_WATERMARKS)
+    conn.execute(SQL_TABLE_PREDICTIONS)
+    conn.execute(SQL_TABLE_MINHASH)
+    conn.execute(SQL_TABLE_LSH_BANDS)
+    conn.execute(SQL_TABLE_NEAR_DUPLICATES)
     conn.execute(SQL_INDEX_METADATA_ID_)
     conn.execute(SQL_INDEX_METADATA_ART_ID)
     conn.execute(SQL_INDEX_CONTENT_ID)
+    conn.execute(SQL_INDEX_ARTICLE_TAGS_TAG)
+    conn.execute(SQL_INDEX_ARTICLE_TAGS_ART_ID)
+    conn.execute(SQL_INDEX_LSH_BANDS_KEY)
 
     conn.commit()
-    conn.close()
 
+    _migrate_store_db(conn)
 
-def _term_index_path(path):
-    return os.path.join(path, TERM_INDEX_ROOT)
 
+def _term_index_backend(name):
+    # Imported on demand so that the native backend never loads the JVM
+    if name == 'lucene':
+        import indexing
+        return indexing
+    elif name == 'native':
+        import term_index
+        return term_index
+    else:
+        raise ValueError("Unknown term index backend %s" % name)
 
-def _init_term_index(path):
-    try:
-        init_lucene()
-    except ValueError:
-        # Lucene already initialized. Ignore exception.
-        pass
 
-    writer = get_writer(path)
+def _term_index_path(path, backend):
+    return os.path.join(path, TERM_INDEX_ROOTS[backend])
+
+
+def _init_term_index(path, index):
+    index.init_backend()
+
+    writer = index.get_writer(path)
     writer.commit()
     writer.close()
 
     return path
 
 
-def _init_store(path):
-    if not os.path.exists(path):
-        os.makedirs(path)
+def _index_from_store(index, writer, store, art_ids, update):
+    num_indexed = 0
+
+    for start in xrange(0, len(art_ids), REINDEX_BATCH_SIZE):
+        for article in store.get_articles(art_ids[start:start + REINDEX_BATCH_SIZE], fields=['cooked_doc']):
+            index.index_article(writer, article['art_id'], article['cooked_doc'], update)
+            num_indexed += 1
+
+    return num_indexed
+
+
+def _update_term_index(index, store, index_dir):
+    indexed = index.indexed_article_ids(index_dir)
+    missing = [art_id for art_id in store.article_ids() if art_id not in indexed]
+
+    logging.info("Indexing %d articles missing from %s" % (len(missing), index_dir))
+
+    writer = index.get_writer(index_dir)
+
+    try:
+        num_indexed = _index_from_store(index, writer, store, missing, True)
+        writer.commit()
+    finally:
+        writer.close()
+
+    return num_indexed
+
+
+def _replace_dir(new_path, path):
+    old_path = path + '.old'
+
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
 
-    _init_store_db(path)
+    if os.path.exists(path):
+        os.rename(path, old_path)
 
-    _init_term_index(_term_index_path(path))
+    os.rename(new_path, path)
+
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def _rebuild_term_index(index, store, index_dir, n_threads):
+    art_ids = list(store.article_ids())
+
+    logging.info("Rebuilding %s from %d articles with %d threads" % (index_dir, len(art_ids), n_threads))
+
+    # Built next to the current index, which is only replaced once every article is indexed
+    build_dir = index_dir + '.rebuild'
+
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+
+    writer = index.get_writer(build_dir, create=True)
+    counts = []
+    errors = []
+
+    def index_partition(partition):
+        try:
+            index.attach_thread()
+            counts.append(_index_from_store(index, writer, store, partition, False))
+        except Exception:
+            logging.exception("Indexing thread failed while rebuilding %s" % index_dir)
+            errors.append(sys.exc_info())
+
+    # Both backends' writers are thread safe
+    threads = [threading.Thread(target=index_partition, args=(art_ids[i::n_threads], )) for i in xrange(n_threads)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        writer.rollback()
+        shutil.rmtree(build_dir, True)
+
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+
+    try:
+        writer.commit()
+    finally:
+        writer.close()
+
+    _replace_dir(build_dir, index_dir)
+
+    return sum(counts)
 
 
 def _db_conn(path):
-    return sqlite3.connect(_store_db_fn(path))
+    # Statements are cached per connection, so reusing the SQL_* constants
+    # on a long-lived connection reuses their prepared statements.
+    conn = sqlite3.connect(_store_db_fn(path), timeout=SQLITE_TIMEOUT, check_same_thread=False,
+                           cached_statements=SQLITE_CACHED_STATEMENTS)
 
+    for pragma, value in SQLITE_PRAGMAS:
+        conn.execute('pragma %s = %s' % (pragma, value))
 
-def _has_article(path, art_id):
-    conn = _db_conn(path)
-    cur = conn.cursor()
+    return conn
 
-    cur.execute(SQL_HAS_ARTICLE, (art_id, ))
-    result = cur.fetchone()
-    conn.close()
+
+class ConnectionPool(object):
+    def __init__(self, path):
+        self.path = path
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns = []
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = _db_conn(self.path)
+            self._local.conn = conn
+
+            with self._lock:
+                self._conns.append(conn)
+
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+
+            self._conns = []
+
+        self._local = threading.local()
+
+
+def _known_art_ids(conn):
+    return set(row[0] for row in conn.execute(SQL_SELECT_KNOWN_ART_IDS))
+
+
+def _existing_art_ids(conn, art_ids):
+    result = set()
+
+    for start in xrange(0, len(art_ids), GET_ARTICLES_CHUNK_SIZE):
+        chunk = art_ids[start:start + GET_ARTICLES_CHUNK_SIZE]
+
+        result.update(row[0] for row in conn.execute(SQL_SELECT_EXISTING_ART_IDS % ', '.join('?' * len(chunk)), chunk))
 
     return result
 
 
-def _add_article(path, article):
-    conn = _db_conn(path)
+def _check_dict_codec(codec):
+    if codec != 'zstd':
+        raise ValueError("Shared dictionaries are only supported by the zstd raw codec")
+    elif zstandard is None:
+        raise ValueError("zstd raw codec requires the zstandard package")
+
+
+class RawCodec(object):
+    def __init__(self, codec=RAW_CODEC, dict_id=None, dictionary=None):
+        if codec == 'zstd' and zstandard is None:
+            raise ValueError("zstd raw codec requires the zstandard package")
+        elif codec not in ('zlib', 'zstd'):
+            raise ValueError("Unknown raw codec %s" % codec)
+
+        if dictionary is not None:
+            _check_dict_codec(codec)
+
+        self.codec = codec
+        self.dict_id = dict_id
+        self.dictionary = dictionary
+
+    def _zstd_dict(self):
+        if self.dictionary is None:
+            return None
+        else:
+            return zstandard.ZstdCompressionDict(bytes(self.dictionary))
+
+    def compress(self, raw):
+        data = raw.encode('utf-8')
+
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor(level=RAW_ZSTD_LEVEL, dict_data=self._zstd_dict()).compress(data)
+        else:
+            return zlib.compress(data, RAW_ZLIB_LEVEL)
+
+    def decompress(self, data):
+        if self.codec == 'zstd':
+            data = zstandard.ZstdDecompressor(dict_data=self._zstd_dict()).decompress(bytes(data))
+        else:
+            data = zlib.decompress(bytes(data))
+
+        return data.decode('utf-8')
+
+
+def _raw_codec(conn, codec):
+    # Only zstd uses dictionaries, a stray row for another codec must not keep the store from opening
+    row = conn.execute(SQL_SELECT_RAW_DICT, (codec, )).fetchone() if codec == 'zstd' else None
+
+    if row:
+        return RawCodec(codec, row[0], row[1])
+    else:
+        return RawCodec(codec)
+
+
+def _train_raw_dict(conn, codec, dict_size, samples):
+    # Checked before anything is written, a dictionary row the codec cannot use would break every later open
+    _check_dict_codec(codec)
+
+    docs = [raw.encode('utf-8') for (raw, ) in conn.execute(SQL_SAMPLE_UNMIGRATED_RAW, (samples, ))]
+
+    if not docs:
+        return _raw_codec(conn, codec)
+
+    dictionary = zstandard.train_dictionary(dict_size, docs).as_bytes()
+
     cur = conn.cursor()
+    cur.execute(SQL_INSERT_RAW_DICT, (codec, sqlite3.Binary(dictionary)))
+    conn.commit()
+
+    logging.info("Trained %d byte %s dictionary from %d documents" % (len(dictionary), codec, len(docs)))
+
+    return RawCodec(codec, cur.lastrowid, dictionary)
+
+
+def _insert_raw(cur, content_id, raw, raw_codec):
+    cur.execute(SQL_INSERT_RAW_CONTENT, (content_id, raw_codec.codec, raw_codec.dict_id,
+                                         sqlite3.Binary(raw_codec.compress(raw))))
+
+
+def _get_raw_doc(conn, art_id):
+    row = conn.execute(SQL_SELECT_RAW_DOC, (art_id, )).fetchone()
+
+    if row is None:
+        return None
+
+    codec, dict_id, data, raw = row
 
-    cur.execute(SQL_INSERT_CONTENT, (article.get('cooked_doc'), article.get('raw_doc')))
+    if data is None:
+        # Not yet migrated to raw_content
+        return raw
+
+    dictionary = None
+
+    if dict_id is not None:
+        dictionary = conn.execute(SQL_SELECT_RAW_DICT_BY_ID, (dict_id, )).fetchone()[0]
+
+    return RawCodec(codec, dict_id, dictionary).decompress(data)
+
+
+def _db_size(conn):
+    return conn.execute(SQL_PAGE_COUNT).fetchone()[0] * conn.execute(SQL_PAGE_SIZE).fetchone()[0]
+
+
+def _migrate_raw_content(conn, raw_codec):
+    size_before = _db_size(conn)
+    raw_bytes = 0
+    compressed_bytes = 0
+
+    cur = conn.cursor()
+    content_ids = [row[0] for row in cur.execute(SQL_SELECT_UNMIGRATED_RAW_IDS)]
+
+    for start in xrange(0, len(content_ids), RAW_MIGRATION_CHUNK_SIZE):
+        chunk = content_ids[start:start + RAW_MIGRATION_CHUNK_SIZE]
+        placeholders = ', '.join('?' * len(chunk))
+
+        for content_id, raw in cur.execute(SQL_SELECT_UNMIGRATED_RAW % placeholders, chunk).fetchall():
+            data = raw_codec.compress(raw)
+            raw_bytes += len(raw.encode('utf-8'))
+            compressed_bytes += len(data)
+
+            cur.execute(SQL_INSERT_RAW_CONTENT, (content_id, raw_codec.codec, raw_codec.dict_id,
+                                                 sqlite3.Binary(data)))
+
+        cur.execute(SQL_CLEAR_RAW % placeholders, chunk)
+        conn.commit()
+
+    conn.execute(SQL_VACUUM)
+
+    return {'migrated': len(content_ids), 'raw_bytes': raw_bytes, 'compressed_bytes': compressed_bytes,
+            'size_before': size_before, 'size_after': _db_size(conn)}
+
+
+def _insert_article(cur, article, raw_codec):
+    cur.execute(SQL_INSERT_CONTENT, (article.get('cooked_doc'), None))
     content_id = cur.lastrowid
+
+    if article.get('raw_doc') is not None:
+        _insert_raw(cur, content_id, article['raw_doc'], raw_codec)
+
     cur.execute(SQL_INSERT_METADATA, (content_id, article['art_id'], unicode(article.get('summary', '')),
                                       unicode(article.get('title', '')), unicode('|'.join(article.get('tags', []))),
                                       unicode(article.get('date'))))
 
+    if article['art_id'] is not None:
+        cur.executemany(SQL_INSERT_ARTICLE_TAG, [(article['art_id'], unicode(tag))
+                                                 for tag in _article_tags(article.get('tags', []))])
+
+
+def _add_article(conn, index, index_path, article, raw_codec):
+    cur = conn.cursor()
+
+    _insert_article(cur, article, raw_codec)
+
     conn.commit()
-    conn.close()
 
-    writer = get_writer(_term_index_path(path))
+    writer = index.get_writer(index_path)
 
-    index_article(writer, article['art_id'], article['cooked_doc'])
+    index.index_article(writer, article['art_id'], article['cooked_doc'])
 
     writer.commit()
     writer.close()
@@ -110,8 +553,7 @@ def _add_article(path, article):
     return article
 
 
-def _get_article_by_id(path, art_id):
-    conn = _db_conn(path)
+def _get_article_by_id(conn, art_id):
     cur = conn.cursor()
     cur.row_factory = sqlite3.Row
 
@@ -125,51 +567,384 @@ def _get_article_by_id(path, art_id):
 
         result.append(article)
 
-    conn.close()
-
     return result
 
 
-def _article_ids(path, filter_empty):
-    conn = _db_conn(path)
-    cur = conn.cursor()
+def _filter_sql(filter_empty, tags_any, tags_all, after_row_id=None):
+    sql = ''
+    params = []
 
     if filter_empty:
-        cur.execute(SQL_SELECT_ART_ID_CONTENT_NOT_EMPTY)
-    else:
-        cur.execute(SQL_SELECT_ART_ID)
+        sql += SQL_FILTER_CONTENT_NOT_EMPTY
+
+    if after_row_id is not None:
+        sql += SQL_FILTER_AFTER_ROW_ID
+        params.append(after_row_id)
+
+    if tags_any:
+        tags_any = list(tags_any)
+        sql += SQL_FILTER_TAGS_ANY % ', '.join('?' * len(tags_any))
+        params += tags_any
+
+    if tags_all:
+        tags_all = list(set(tags_all))
+        sql += SQL_FILTER_TAGS_ALL % ', '.join('?' * len(tags_all))
+        params += tags_all + [len(tags_all)]
+
+    return sql, params
+
+
+def _article_ids(conn, filter_empty, tags_any, tags_all):
+    cur = conn.cursor()
+
+    sql, params = _filter_sql(filter_empty, tags_any, tags_all)
+    cur.execute(SQL_SELECT_ARTICLES % ARTICLE_COLUMNS['art_id'] + sql, params)
 
     for row in cur:
         yield row[0]
 
-    conn.close()
 
+def _tag_counts(conn):
+    return dict(conn.execute(SQL_TAG_COUNTS).fetchall())
+
+
+def _article_fields(fields):
+    if fields is None:
+        return ARTICLE_FIELDS
+
+    fields = list(fields)
+
+    for field in fields:
+        if field not in ARTICLE_COLUMNS:
+            raise ValueError("Unknown article field %s" % field)
+
+    # art_id is always returned so that results can be matched to ids
+    if 'art_id' not in fields:
+        fields.insert(0, 'art_id')
+
+    return fields
+
+
+def _row_to_article(fields, row):
+    article = dict(zip(fields, row))
+
+    if 'tags' in article:
+        article['tags'] = article['tags'].split('|')
+
+    return article
+
+
+def _iter_articles(conn, fields, filter_empty, tags_any, tags_all, batch_size, after_row_id=None):
+    cur = conn.cursor()
+
+    sql, params = _filter_sql(filter_empty, tags_any, tags_all, after_row_id)
+    cur.execute(SQL_SELECT_ARTICLES % ', '.join(ARTICLE_COLUMNS[field] for field in fields) + sql, params)
+
+    while True:
+        rows = cur.fetchmany(batch_size)
 
-def _article_count(path):
-    conn = _db_conn(path)
+        if not rows:
+            break
 
+        for row in rows:
+            yield _row_to_article(fields, row)
+
+
+def _get_articles(conn, art_ids, fields):
+    cur = conn.cursor()
+
+    select = SQL_SELECT_ARTICLES % ', '.join(ARTICLE_COLUMNS[field] for field in fields)
+
+    result = {}
+
+    for start in xrange(0, len(art_ids), GET_ARTICLES_CHUNK_SIZE):
+        chunk = art_ids[start:start + GET_ARTICLES_CHUNK_SIZE]
+
+        cur.execute(select + SQL_FILTER_ART_ID_IN % ', '.join('?' * len(chunk)), chunk)
+
+        for row in cur:
+            article = _row_to_article(fields, row)
+            result[article['art_id']] = article
+
+    return result
+
+
+def _get_feed_state(conn, url):
+    row = conn.execute(SQL_SELECT_FEED_STATE, (url, )).fetchone()
+
+    if row:
+        return {'etag': row[0], 'modified': row[1], 'interval': row[2]}
+    else:
+        return {}
+
+
+def _set_feed_state(conn, url, state):
+    conn.execute(SQL_REPLACE_FEED_STATE, (url, state.get('etag'), state.get('modified'), state.get('interval')))
+    conn.commit()
+
+
+def _get_watermark(conn, name, default):
+    row = conn.execute(SQL_SELECT_WATERMARK, (name, )).fetchone()
+
+    return row[0] if row else default
+
+
+def _set_watermark(conn, name, value):
+    conn.execute(SQL_REPLACE_WATERMARK, (name, value))
+    conn.commit()
+
+
+def _unpredicted_article_ids(conn, model):
+    return [row[0] for row in conn.execute(SQL_SELECT_UNPREDICTED_ART_IDS, (model, ))]
+
+
+def _put_predictions(conn, model, predictions):
+    conn.executemany(SQL_REPLACE_PREDICTION, [(art_id, model, topic, score) for art_id, topic, score in predictions])
+    conn.commit()
+
+
+def _get_predictions(conn, model, art_ids):
+    result = {}
+
+    for start in xrange(0, len(art_ids), GET_ARTICLES_CHUNK_SIZE):
+        chunk = art_ids[start:start + GET_ARTICLES_CHUNK_SIZE]
+
+        for art_id, topic, score in conn.execute(SQL_SELECT_PREDICTIONS % ', '.join('?' * len(chunk)),
+                                                 [model] + chunk):
+            result[art_id] = (topic, score)
+
+    return result
+
+
+def _put_minhash(conn, art_id, signature, band_keys, commit):
+    conn.execute(SQL_REPLACE_MINHASH, (art_id, sqlite3.Binary(signature)))
+    conn.execute(SQL_DELETE_LSH_BANDS, (art_id, ))
+    conn.executemany(SQL_INSERT_LSH_BAND, [(key, art_id) for key in band_keys])
+
+    if commit:
+        conn.commit()
+
+
+def _lsh_candidates(conn, band_keys):
+    return set(row[0] for row in conn.execute(SQL_SELECT_LSH_CANDIDATES % ', '.join('?' * len(band_keys)),
+                                              band_keys))
+
+
+def _select_in(conn, sql, values):
+    # Runs a query with an IN (...) clause in chunks below the SQLite variable limit
+    for start in xrange(0, len(values), GET_ARTICLES_CHUNK_SIZE):
+        chunk = values[start:start + GET_ARTICLES_CHUNK_SIZE]
+
+        for row in conn.execute(sql % ', '.join('?' * len(chunk)), chunk):
+            yield row
+
+
+def _get_minhashes(conn, art_ids):
+    return dict((art_id, str(signature)) for art_id, signature in _select_in(conn, SQL_SELECT_MINHASHES, art_ids))
+
+
+def _put_near_duplicate(conn, art_id, duplicate_of, similarity, commit):
+    conn.execute(SQL_REPLACE_NEAR_DUPLICATE, (art_id, duplicate_of, similarity))
+
+    if commit:
+        conn.commit()
+
+
+def _article_count(conn):
     cur = conn.cursor()
     cur.execute(SQL_ARTICLE_COUNT)
-    count = int(cur.fetchone()[0])
 
-    conn.close()
+    return int(cur.fetchone()[0])
+
+
+class ArticleBatch(object):
+    def __init__(self, conn, index, index_path, raw_codec, commit_interval=BATCH_COMMIT_INTERVAL,
+                 known_art_ids=None):
+        self.conn = conn
+        self.index = index
+        self.index_path = index_path
+        self.raw_codec = raw_codec
+        self.commit_interval = commit_interval
+        self.known_art_ids = known_art_ids if known_art_ids is not None else set()
+
+        self.inserted = 0
+        self.skipped = 0
+
+        self._writer = None
+        self._pending = 0
+        self._seen = set()
+        self._uncommitted = []
+
+    def open(self):
+        self._writer = self.index.get_writer(self.index_path)
+
+        return self
+
+    def add(self, article):
+        art_id = article['art_id']
+        cur = self.conn.cursor()
+
+        if art_id in self._seen or art_id in self.known_art_ids or \
+                (art_id is not None and cur.execute(SQL_HAS_ARTICLE, (art_id, )).fetchone()):
+            self.skipped += 1
+            return False
+
+        _insert_article(cur, article, self.raw_codec)
+        self.index.index_article(self._writer, art_id, article['cooked_doc'])
+
+        if art_id is not None:
+            self._seen.add(art_id)
+            self._uncommitted.append(art_id)
+
+        self.inserted += 1
+        self._pending += 1
+
+        if self.commit_interval and self._pending >= self.commit_interval:
+            self.commit()
+
+        return True
+
+    def add_all(self, articles):
+        for article in articles:
+            self.add(article)
+
+        return self.inserted, self.skipped
+
+    def commit(self):
+        self.conn.commit()
+        self._writer.commit()
+        self._pending = 0
+
+        self.known_art_ids.update(self._uncommitted)
+        self._uncommitted = []
+
+    def rollback(self):
+        self.conn.rollback()
+
+        self._seen.difference_update(self._uncommitted)
+        self._uncommitted = []
+
+        # IndexWriter.rollback() also closes the writer
+        self._writer.rollback()
+        self._writer = None
+        self._pending = 0
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
 
-    return count
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+
+        return False
 
 
 class ArticleStore(object):
-    def __init__(self, path):
+    def __init__(self, path, raw_codec=RAW_CODEC, index_backend=TERM_INDEX_BACKEND, index=True):
         self.path = path
+        self.index_backend = index_backend
+        self.index_path = _term_index_path(path, index_backend)
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self._pool = ConnectionPool(path)
+
+        # Loaded on first membership check and kept up to date on insert
+        self._known_art_ids = None
+        self._known_lock = threading.Lock()
+
+        # The term index backend is imported and opened on first use. Without it the SQLite part of the store
+        # is still written to, only adding and indexing articles is rejected.
+        self.index = index
+        self._index = None
+        self._index_lock = threading.Lock()
+
+        self._annotation_cache = None
+
+        _init_store_db(self._conn())
+
+        self.raw_codec = _raw_codec(self._conn(), raw_codec)
+
+    def _conn(self):
+        return self._pool.get()
+
+    def term_index(self):
+        if not self.index:
+            raise ValueError("Store %s was opened without term index, articles can not be added or indexed" % self.path)
+
+        with self._index_lock:
+            if self._index is None:
+                index = _term_index_backend(self.index_backend)
+                _init_term_index(self.index_path, index)
+
+                self._index = index
+
+        return self._index
+
+    def attach_thread(self):
+        # Needed once in each new thread that writes to the term index
+        self.term_index().attach_thread()
+
+    def annotation_cache(self, max_bytes=None):
+        from annotation_cache import AnnotationCache, annotation_cache_fn
+
+        with self._index_lock:
+            if self._annotation_cache is None:
+                self._annotation_cache = AnnotationCache(annotation_cache_fn(self.path))
+
+        if max_bytes is not None:
+            self._annotation_cache.max_bytes = max_bytes
 
-        _init_store(path)
+        return self._annotation_cache
+
+    def close(self):
+        if self._annotation_cache is not None:
+            self._annotation_cache.close()
+            self._annotation_cache = None
+
+        self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+        return False
 
     def add_article(self, article):
-        _add_article(self.path, article)
+        _add_article(self._conn(), self.term_index(), self.index_path, article, self.raw_codec)
+
+        if article['art_id'] is not None:
+            self.known_art_ids().add(article['art_id'])
 
         return article['art_id']
 
+    def batch(self, commit_interval=BATCH_COMMIT_INTERVAL):
+        return ArticleBatch(self._conn(), self.term_index(), self.index_path, self.raw_codec, commit_interval,
+                            self.known_art_ids())
+
+    def add_articles(self, articles, commit_interval=BATCH_COMMIT_INTERVAL):
+        with self.batch(commit_interval) as batch:
+            batch.add_all(articles)
+
+        logging.info("Added %d articles, skipped %d already in store" % (batch.inserted, batch.skipped))
+
+        return batch.inserted, batch.skipped
+
     def get_article_by_id(self, art_id, duplicates=False):
-        articles = _get_article_by_id(self.path, art_id)
+        articles = _get_article_by_id(self._conn(), art_id)
 
         if not duplicates and len(articles) > 1:
             logging.warn("Duplicate articles for id %d" % art_id)
@@ -179,12 +954,163 @@ class ArticleStore(object):
         else:
             return articles[0]
 
+    def update_term_index(self, rebuild=False, threads=REBUILD_THREADS):
+        if rebuild:
+            return _rebuild_term_index(self.term_index(), self, self.index_path, threads)
+        else:
+            return _update_term_index(self.term_index(), self, self.index_path)
+
+    def get_raw_doc(self, art_id):
+        return _get_raw_doc(self._conn(), art_id)
+
+    def migrate_raw_content(self, codec=None, train_dictionary=False, dict_size=RAW_DICT_SIZE,
+                            dict_samples=RAW_DICT_SAMPLES):
+        if codec:
+            self.raw_codec = _raw_codec(self._conn(), codec)
+
+        if train_dictionary:
+            self.raw_codec = _train_raw_dict(self._conn(), self.raw_codec.codec, dict_size, dict_samples)
+
+        report = _migrate_raw_content(self._conn(), self.raw_codec)
+
+        logging.info("Migrated %d raw documents with %s: %d -> %d bytes raw, store %d -> %d bytes" %
+                     (report['migrated'], self.raw_codec.codec, report['raw_bytes'], report['compressed_bytes'],
+                      report['size_before'], report['size_after']))
+
+        return report
+
+    def known_art_ids(self):
+        with self._known_lock:
+            if self._known_art_ids is None:
+                self._known_art_ids = _known_art_ids(self._conn())
+
+            return self._known_art_ids
+
+    def missing_article_ids(self, art_ids):
+        known = self.known_art_ids()
+        candidates = list(set(art_id for art_id in art_ids if art_id is not None and art_id not in known))
+
+        # Another process may have added some of these since the set was loaded
+        existing = _existing_art_ids(self._conn(), candidates)
+        known.update(existing)
+
+        return set(candidates) - existing
+
     def has_article(self, art_id):
-        return _has_article(self.path, art_id)
+        return art_id is not None and art_id not in self.missing_article_ids([art_id])
+
+    def iter_articles(self, fields=None, filter_empty=True, tags_any=None, tags_all=None,
+                      batch_size=ITER_BATCH_SIZE, after_row_id=None):
+        return _iter_articles(self._conn(), _article_fields(fields), filter_empty, tags_any, tags_all, batch_size,
+                              after_row_id)
+
+    def get_articles(self, art_ids, fields=None):
+        art_ids = list(art_ids)
+        articles = _get_articles(self._conn(), art_ids, _article_fields(fields))
+
+        return [articles[art_id] for art_id in art_ids if art_id in articles]
+
+    def article_ids(self, filter_empty=True, tags_any=None, tags_all=None):
+        return _article_ids(self._conn(), filter_empty, tags_any, tags_all)
+
+    def tag_counts(self):
+        return _tag_counts(self._conn())
+
+    def get_annotations(self, art_ids, layer):
+        articles = self.get_articles(art_ids, fields=['cooked_doc'])
+        annotations = self.annotation_cache().annotate(layer, [article['cooked_doc'] for article in articles])
+
+        return dict((article['art_id'], value) for article, value in zip(articles, annotations))
+
+    def get_feed_state(self, url):
+        return _get_feed_state(self._conn(), url)
+
+    def set_feed_state(self, url, state):
+        _set_feed_state(self._conn(), url, state)
+
+    def get_watermark(self, name, default=0):
+        return _get_watermark(self._conn(), name, default)
+
+    def set_watermark(self, name, value):
+        _set_watermark(self._conn(), name, value)
+
+    def unpredicted_article_ids(self, model):
+        return _unpredicted_article_ids(self._conn(), model)
+
+    def put_predictions(self, model, predictions):
+        _put_predictions(self._conn(), model, predictions)
+
+    def get_predictions(self, model, art_ids):
+        return _get_predictions(self._conn(), model, list(art_ids))
+
+    def put_minhash(self, art_id, signature, band_keys, commit=True):
+        _put_minhash(self._conn(), art_id, signature, list(band_keys), commit)
 
-    def article_ids(self, filter_empty=True):
-        return _article_ids(self.path, filter_empty)
+    def lsh_candidates(self, band_keys):
+        return _lsh_candidates(self._conn(), list(band_keys))
+
+    def get_minhashes(self, art_ids):
+        return _get_minhashes(self._conn(), list(art_ids))
+
+    def minhash_art_ids(self):
+        return set(row[0] for row in self._conn().execute(SQL_SELECT_MINHASH_ART_IDS))
+
+    def put_near_duplicate(self, art_id, duplicate_of, similarity, commit=True):
+        _put_near_duplicate(self._conn(), art_id, duplicate_of, similarity, commit)
+
+    def commit(self):
+        self._conn().commit()
+
+    def near_duplicate_ids(self, art_ids):
+        return set(row[0] for row in _select_in(self._conn(), SQL_SELECT_NEAR_DUPLICATE_IDS,
+                                                [art_id for art_id in art_ids if art_id is not None]))
 
     def __len__(self):
-        return _article_count(self.path)
+        return _article_count(self._conn())
+
+
+def startup_benchmark(path, index_backend=TERM_INDEX_BACKEND, runs=STARTUP_BENCHMARK_RUNS):
+    # Every run is a fresh interpreter so that JVM start up is included. Opening the store once beforehand
+    # applies any pending schema migrations, so that they are not timed as part of the first run.
+    ArticleStore(path, index=False).close()
+
+    results = {}
+
+    for mode in ('none', 'lazy', 'eager'):
+        results[mode] = [float(subprocess.check_output([sys.executable, '-c', STARTUP_BENCHMARK_SCRIPT, path,
+                                                        index_backend, mode],
+                                                       cwd=os.path.dirname(os.path.abspath(__file__))))
+                         for _ in xrange(runs)]
+
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option('-s', '--store')
+    parser.add_option('--migrate-raw', action='store_true')
+    parser.add_option('--raw-codec', default=RAW_CODEC)
+    parser.add_option('--train-dictionary', action='store_true')
+    parser.add_option('--startup-benchmark', action='store_true')
+    parser.add_option('--index-backend', default=TERM_INDEX_BACKEND)
+
+    opts, args = parser.parse_args()
+
+    if opts.store:
+        store_path = os.path.abspath(opts.store)
+    else:
+        raise ValueError('--store argument is required')
+
+    if opts.train_dictionary and opts.raw_codec != 'zstd':
+        raise ValueError('--train-dictionary requires --raw-codec zstd')
+
+    if opts.migrate_raw:
+        with ArticleStore(store_path, index=False) as store:
+            store.migrate_raw_content(opts.raw_codec, opts.train_dictionary)
 
+    if opts.startup_benchmark:
+        for mode, timings in startup_benchmark(store_path, opts.index_backend).items():
+            logging.info("Startup with index=%s: min %.3fs, mean %.3fs over %d runs" %
+                         (mode, min(timings), sum(timings) / len(timings), len(timings)))
@@ -0,0 +1,462 @@
+from collections import Counter, defaultdict
+import cPickle
+import fcntl
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import threading
+import uuid
+
+import numpy as np
+
+
+SEGMENTS_FN = 'segments.json'
+LOCK_FN = 'write.lock'
+
+MAX_BUFFERED_DOCS = 10000
+# Once this many segments of the same size class exist, a commit merges them into one,
+# which keeps the number of segments logarithmic in the number of documents
+MERGE_FACTOR = 10
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_segments_lock = threading.Lock()
+
+# Readers shared by the module level functions, reopened when the segment list changes
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+
+def encode_varints(values):
+    values = np.asarray(values, dtype=np.uint64)
+
+    # Number of 7 bit groups needed for each value
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+
+    starts = np.cumsum(n_bytes) - n_bytes
+    pos = np.arange(n_bytes.sum()) - np.repeat(starts, n_bytes)
+
+    groups = (np.repeat(values, n_bytes) >> (np.uint64(7) * pos.astype(np.uint64))) & np.uint64(0x7f)
+    groups[pos < np.repeat(n_bytes - 1, n_bytes)] |= np.uint64(0x80)
+
+    return groups.astype(np.uint8), n_bytes
+
+
+def decode_varints(data):
+    data = np.frombuffer(data, dtype=np.uint8)
+
+    if not len(data):
+        return np.zeros(0, dtype=np.uint64)
+
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    pos = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+
+    groups = (data & 0x7f).astype(np.uint64) << (np.uint64(7) * pos.astype(np.uint64))
+
+    return np.add.reduceat(groups, starts)
+
+
+def _segment_fn(path, segment, ext):
+    return os.path.join(path, '%s.%s' % (segment, ext))
+
+
+def _read_segments(path):
+    fn = os.path.join(path, SEGMENTS_FN)
+
+    if not os.path.exists(fn):
+        return []
+
+    with open(fn) as f:
+        return json.load(f)['segments']
+
+
+def _update_segments(path, update):
+    # Serialize read-modify-write of the segment list between threads and processes
+    with _segments_lock:
+        with open(os.path.join(path, LOCK_FN), 'a') as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+
+            try:
+                segments = update(_read_segments(path))
+
+                tmp_fn = os.path.join(path, SEGMENTS_FN + '.tmp')
+
+                with open(tmp_fn, 'w') as f:
+                    json.dump({'segments': segments}, f)
+
+                os.rename(tmp_fn, os.path.join(path, SEGMENTS_FN))
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    return segments
+
+
+def _remove_segment_files(path, segments):
+    for segment in segments:
+        for ext in ('docs.npy', 'lens.npy', 'terms', 'post'):
+            fn = _segment_fn(path, segment, ext)
+
+            if os.path.exists(fn):
+                os.remove(fn)
+
+
+def _write_segment(path, art_ids, doc_lens, postings):
+    segment = 'seg_%s' % uuid.uuid4().hex
+
+    terms = sorted(postings)
+    values = []
+    n_values = []
+
+    for term in terms:
+        doc_idx, tfs = postings[term]
+        values += [doc_idx[0]] + [b - a for a, b in zip(doc_idx, doc_idx[1:])] + tfs
+        n_values.append(len(tfs))
+
+    data, n_bytes = encode_varints(values)
+
+    # Byte offset of each term's postings in the segment file
+    value_ends = np.cumsum(np.asarray(n_values, dtype=np.int64) * 2)
+    byte_ends = np.cumsum(n_bytes)[value_ends - 1] if len(terms) else np.zeros(0, dtype=np.int64)
+    byte_starts = np.concatenate(([0], byte_ends[:-1]))
+
+    term_dict = dict((term, (int(start), int(end - start), df))
+                     for term, start, end, df in zip(terms, byte_starts, byte_ends, n_values))
+
+    with open(_segment_fn(path, segment, 'post'), 'wb') as f:
+        f.write(data.tostring())
+
+    with open(_segment_fn(path, segment, 'terms'), 'wb') as f:
+        cPickle.dump(term_dict, f, cPickle.HIGHEST_PROTOCOL)
+
+    np.save(_segment_fn(path, segment, 'docs.npy'), np.asarray(art_ids, dtype=np.int64))
+    np.save(_segment_fn(path, segment, 'lens.npy'), np.asarray(doc_lens, dtype=np.int32))
+
+    return segment
+
+
+class TermIndexWriter(object):
+    def __init__(self, path, create=False, max_buffered_docs=MAX_BUFFERED_DOCS):
+        self.path = path
+        self.max_buffered_docs = max_buffered_docs
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        if create:
+            old_segments = []
+
+            def clear(segments):
+                old_segments.extend(segments)
+                return []
+
+            _update_segments(path, clear)
+            _remove_segment_files(path, old_segments)
+
+        self._new_segments = []
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._art_ids = []
+        self._doc_lens = []
+        self._postings = defaultdict(lambda: ([], []))
+
+    def add_document(self, art_id, art_body):
+        tokens = tokenize(art_body or u'')
+        counts = Counter(tokens)
+
+        # The writer may be shared between indexing threads
+        with self._lock:
+            doc_idx = len(self._art_ids)
+
+            self._art_ids.append(art_id)
+            self._doc_lens.append(len(tokens))
+
+            for term, tf in counts.iteritems():
+                doc_postings = self._postings[term]
+                doc_postings[0].append(doc_idx)
+                doc_postings[1].append(tf)
+
+            if len(self._art_ids) >= self.max_buffered_docs:
+                self._flush()
+
+    def _flush(self):
+        if self._art_ids:
+            self._new_segments.append(_write_segment(self.path, self._art_ids, self._doc_lens, self._postings))
+            self._reset()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def commit(self):
+        with self._lock:
+            self._flush()
+
+            if not self._new_segments:
+                return
+
+            new_segments = self._new_segments
+            _update_segments(self.path, lambda segments: segments + new_segments)
+            self._new_segments = []
+
+        _tiered_merge(self.path)
+
+    def rollback(self):
+        with self._lock:
+            self._reset()
+            _remove_segment_files(self.path, self._new_segments)
+            self._new_segments = []
+
+    def close(self):
+        self.commit()
+
+
+class _Segment(object):
+    def __init__(self, path, name):
+        self.name = name
+        self.art_ids = np.load(_segment_fn(path, name, 'docs.npy'))
+        self.doc_lens = np.load(_segment_fn(path, name, 'lens.npy'))
+
+        with open(_segment_fn(path, name, 'terms'), 'rb') as f:
+            self.terms = cPickle.load(f)
+
+        with open(_segment_fn(path, name, 'post'), 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.postings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.postings = ''
+
+    def term_postings(self, term):
+        offset, length, df = self.terms[term]
+        values = decode_varints(self.postings[offset:offset + length]).astype(np.int64)
+
+        return np.cumsum(values[:df]), values[df:]
+
+
+class TermIndexReader(object):
+    def __init__(self, path, names=None, cached=None):
+        # Segments are immutable, so those of an earlier reader can be reused
+        cached = cached or {}
+
+        self.path = path
+        self.names = _read_segments(path) if names is None else names
+        self.segments = [cached.get(name) or _Segment(path, name) for name in self.names]
+
+        if self.segments:
+            self.art_ids = np.concatenate([segment.art_ids for segment in self.segments])
+            self.doc_lens = np.concatenate([segment.doc_lens for segment in self.segments]).astype(np.float64)
+        else:
+            self.art_ids = np.zeros(0, dtype=np.int64)
+            self.doc_lens = np.zeros(0, dtype=np.float64)
+
+        self.offsets = np.cumsum([0] + [len(segment.art_ids) for segment in self.segments])
+
+        # Later documents replace earlier ones with the same art_id
+        _, last = np.unique(self.art_ids[::-1], return_index=True)
+        self.live = np.zeros(len(self.art_ids), dtype=bool)
+        self.live[len(self.art_ids) - 1 - last] = True
+
+        self.num_docs = int(self.live.sum())
+        self.avg_doc_len = self.doc_lens[self.live].mean() if self.num_docs else 0.0
+
+    def __contains__(self, art_id):
+        return bool(np.any(self.art_ids == art_id))
+
+    def article_ids(self):
+        return set(int(art_id) for art_id in self.art_ids)
+
+    def postings(self, term):
+        doc_idx = []
+        tfs = []
+
+        for offset, segment in zip(self.offsets, self.segments):
+            if term in segment.terms:
+                idx, tf = segment.term_postings(term)
+                doc_idx.append(idx + offset)
+                tfs.append(tf)
+
+        if not doc_idx:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(doc_idx), np.concatenate(tfs)
+
+    def scores(self, term):
+        scores = np.zeros(len(self.art_ids), dtype=np.float64)
+
+        for token in set(tokenize(term)):
+            doc_idx, tfs = self.postings(token)
+
+            live = self.live[doc_idx]
+            doc_idx = doc_idx[live]
+            tfs = tfs[live].astype(np.float64)
+
+            if not len(doc_idx):
+                continue
+
+            # BM25, with one document frequency for the whole index
+            df = len(doc_idx)
+            idf = np.log(1.0 + (self.num_docs - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1.0 - BM25_B + BM25_B * self.doc_lens[doc_idx] / self.avg_doc_len)
+
+            scores[doc_idx] += idf * tfs * (BM25_K1 + 1.0) / (tfs + norm)
+
+        return scores
+
+    def search(self, term, n_docs=10):
+        scores = self.scores(term)
+        hits = np.flatnonzero(scores > 0)
+
+        if len(hits) > n_docs:
+            hits = hits[np.argpartition(-scores[hits], n_docs - 1)[:n_docs]]
+
+        hits = hits[np.argsort(-scores[hits], kind='mergesort')]
+
+        return [(int(self.art_ids[i]), float(scores[i])) for i in hits]
+
+    def merge(self, names=None):
+        selected = [(offset, segment) for offset, segment in zip(self.offsets, self.segments)
+                    if names is None or segment.name in names]
+
+        if not selected:
+            return None
+
+        # Live documents of the merged segments, in index order
+        positions = np.concatenate([np.arange(offset, offset + len(segment.art_ids)) for offset, segment in selected])
+        positions = positions[self.live[positions]]
+
+        new_idx = np.zeros(len(self.art_ids), dtype=np.int64)
+        new_idx[positions] = np.arange(len(positions))
+
+        postings = defaultdict(lambda: ([], []))
+
+        for offset, segment in selected:
+            for term in segment.terms:
+                doc_idx, tfs = segment.term_postings(term)
+                doc_idx += offset
+                keep = self.live[doc_idx]
+
+                if not keep.any():
+                    continue
+
+                postings[term][0].extend(new_idx[doc_idx[keep]].tolist())
+                postings[term][1].extend(tfs[keep].tolist())
+
+        old_segments = [segment.name for _, segment in selected]
+        merged = _write_segment(self.path, self.art_ids[positions], self.doc_lens[positions], postings)
+        replaced = []
+
+        def replace(segments):
+            if not all(segment in segments for segment in old_segments):
+                # Merged by another writer in the meantime
+                return segments
+
+            replaced.append(True)
+
+            # The merged segment takes the place of the last segment it replaces, so that documents
+            # committed after any of them still replace the merged ones
+            last = max(segments.index(segment) for segment in old_segments)
+
+            return [segment for segment in segments[:last] if segment not in old_segments] + [merged] + \
+                segments[last + 1:]
+
+        _update_segments(self.path, replace)
+
+        if not replaced:
+            _remove_segment_files(self.path, [merged])
+            return None
+
+        _remove_segment_files(self.path, old_segments)
+
+        logging.info("Merged %d segments in %s" % (len(old_segments), self.path))
+
+        return merged
+
+
+def _segment_tier(path, name, merge_factor):
+    n_docs = np.load(_segment_fn(path, name, 'docs.npy'), mmap_mode='r').shape[0]
+
+    return int(math.log(max(n_docs, 1), merge_factor))
+
+
+def _tiered_merge(path, merge_factor=MERGE_FACTOR):
+    while True:
+        tiers = defaultdict(list)
+
+        for name in _read_segments(path):
+            tiers[_segment_tier(path, name, merge_factor)].append(name)
+
+        full = [tier for tier, names in tiers.items() if len(names) >= merge_factor]
+
+        if not full or TermIndexReader(path).merge(tiers[min(full)]) is None:
+            return
+
+
+def _reader(path):
+    path = os.path.abspath(path)
+
+    with _readers_lock:
+        reader = _readers.get(path)
+        names = _read_segments(path)
+
+        if reader is None or reader.names != names:
+            cached = dict((segment.name, segment) for segment in reader.segments) if reader else None
+
+            try:
+                reader = TermIndexReader(path, names, cached)
+            except (IOError, OSError):
+                # Segment files removed by a merge after the list was read
+                reader = TermIndexReader(path, cached=cached)
+
+            _readers[path] = reader
+
+    return reader
+
+
+def init_backend():
+    pass
+
+
+def attach_thread():
+    pass
+
+
+def get_writer(index='index', create=False):
+    return TermIndexWriter(index, create)
+
+
+def index_article(writer, art_id, art_body, update=False):
+    # Documents always replace earlier ones with the same art_id
+    writer.add_document(art_id, art_body)
+
+
+def is_article_indexed(art_id, index='index'):
+    return art_id in _reader(index)
+
+
+def indexed_article_ids(index='index'):
+    return _reader(index).article_ids()
+
+
+def search(term, n_docs=10, index='index'):
+    return _reader(index).search(term, n_docs)
+
+
+def merge_index(index='index'):
+    return TermIndexReader(index).merge()
@@ -1,40 +1,275 @@
 import itertools
+import logging
+from optparse import OptionParser
+import os
+import shutil
 
-from gensim.corpora import Dictionary
-from gensim.models import LdaModel, TfidfModel
+from gensim.corpora import Dictionary, MmCorpus
+from gensim.models import LdaModel, LdaMulticore, TfidfModel
 from gensim.utils import deaccent
 from nltk.corpus import stopwords
 
+from corpus import EncodedCorpus, corpus_path
+from preprocessing import preprocess_many
+from store import ArticleStore
+
+
+CORPUS_FN = 'corpus.mm'
+DICTIONARY_FN = 'dictionary'
+TFIDF_FN = 'tfidf'
+LDA_FN = 'lda'
+
+LDA_PASSES = 20
+LDA_CHUNKSIZE = 2000
+UPDATE_CHUNKSIZE = 2000
+UPDATE_PASSES = 1
+TOPIC_MODEL_WATERMARK = 'topic_model:%s'
+
+_stopwords = None
+
+
+def get_stopwords():
+    global _stopwords
+
+    if _stopwords is None:
+        _stopwords = frozenset(stopwords.words('norwegian'))
+
+    return _stopwords
+
 
 def article_to_bow(article):
-    tokens = [deaccent(tok).lower() for tok in list(itertools.chain(*article))
-              if tok not in stopwords.words('norwegian') and tok.isalpha()]
+    stop = get_stopwords()
+
+    tokens = [deaccent(tok).lower() for tok in itertools.chain(*article)
+              if tok not in stop and tok.isalpha()]
 
     return tokens
 
 
-def train_lda_model(articles, num_topics=10):
+def _lda_model(corpus, num_topics, dict, workers, chunksize):
+    if workers:
+        return LdaMulticore(corpus=corpus, num_topics=num_topics, id2word=dict, workers=workers,
+                            chunksize=chunksize, passes=LDA_PASSES)
+    else:
+        return LdaModel(corpus=corpus, num_topics=num_topics, chunksize=chunksize,
+                        update_every=0, passes=LDA_PASSES, id2word=dict)
+
+
+def train_lda_model(articles, num_topics=10, workers=None, chunksize=LDA_CHUNKSIZE):
     docs = [article_to_bow(a) for a in articles]
 
     dict = Dictionary(docs)
     dict.filter_extremes()
     dict.compactify()
 
-    corpus = [dict.doc2bow(article_to_bow(a)) for a in articles]
+    corpus = [dict.doc2bow(doc) for doc in docs]
 
     tfidf = TfidfModel(corpus=corpus, id2word=dict)
 
-    w_corpus = [tfidf[doc] for doc in corpus]
+    w_corpus = tfidf[corpus]
+
+    lda = _lda_model(w_corpus, num_topics, dict, workers, chunksize)
+
+    return lda, tfidf, dict
+
+
+def _remove_corpus(corpus_fn):
+    for fn in (corpus_fn, corpus_fn + '.index'):
+        if os.path.exists(fn):
+            os.remove(fn)
+
+
+def _remapped_corpus(corpus, id_map):
+    for doc in corpus:
+        yield sorted((id_map[term_id], count) for term_id, count in doc if term_id in id_map)
 
-    lda = LdaModel(corpus=w_corpus, num_topics=num_topics,
-                   update_every=0, passes=20, id2word=dict)
+
+def serialize_corpus(articles, corpus_fn):
+    # The dictionary is built in the same pass that writes the unfiltered
+    # corpus, which is then rewritten from disk with the filtered ids.
+    unfiltered_fn = corpus_fn + '.unfiltered'
+
+    dictionary = Dictionary()
+    MmCorpus.serialize(unfiltered_fn, (dictionary.doc2bow(article_to_bow(a), allow_update=True) for a in articles))
+
+    tokens = dict((term_id, token) for token, term_id in dictionary.token2id.iteritems())
+
+    dictionary.filter_extremes()
+    dictionary.compactify()
+
+    id_map = dict((term_id, dictionary.token2id[token]) for term_id, token in tokens.iteritems()
+                  if token in dictionary.token2id)
+
+    MmCorpus.serialize(corpus_fn, _remapped_corpus(MmCorpus(unfiltered_fn), id_map))
+    _remove_corpus(unfiltered_fn)
+
+    return dictionary, MmCorpus(corpus_fn)
+
+
+def train_lda_model_streaming(articles, corpus_dir, num_topics=10, workers=None, chunksize=LDA_CHUNKSIZE):
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+
+    dict, corpus = serialize_corpus(articles, os.path.join(corpus_dir, CORPUS_FN))
+
+    tfidf = TfidfModel(corpus=corpus, id2word=dict)
+
+    lda = _lda_model(tfidf[corpus], num_topics, dict, workers, chunksize)
 
     return lda, tfidf, dict
 
 
+class StoreDocuments(object):
+    def __init__(self, store, n_jobs=1, after_row_id=None):
+        self.store = store
+        self.n_jobs = n_jobs
+        self.after_row_id = after_row_id
+
+        # Highest store row seen so far, used as the watermark for the next update
+        self.last_row_id = after_row_id
+
+    def _texts(self):
+        for article in self.store.iter_articles(fields=['row_id', 'cooked_doc'], after_row_id=self.after_row_id):
+            self.last_row_id = max(self.last_row_id, article['row_id'])
+
+            yield article['cooked_doc']
+
+    def __iter__(self):
+        return preprocess_many(self._texts(), n_jobs=self.n_jobs)
+
+
 def update_lda_model(lda, tfidf, dict, articles):
     corpus = [tfidf[dict.doc2bow(article_to_bow(a))] for a in articles]
 
     lda.update(corpus)
 
     return lda
+
+
+def save_topic_model(model_dir, lda, tfidf, dict):
+    # Written to a temporary directory and swapped in, so readers never see a partial checkpoint
+    tmp_dir = model_dir + '.tmp'
+    old_dir = model_dir + '.old'
+
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    os.makedirs(tmp_dir)
+
+    lda.save(os.path.join(tmp_dir, LDA_FN))
+    tfidf.save(os.path.join(tmp_dir, TFIDF_FN))
+    dict.save(os.path.join(tmp_dir, DICTIONARY_FN))
+
+    if os.path.exists(model_dir):
+        if os.path.exists(old_dir):
+            shutil.rmtree(old_dir)
+
+        os.rename(model_dir, old_dir)
+
+    os.rename(tmp_dir, model_dir)
+
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
+def load_topic_model(model_dir):
+    if not os.path.exists(model_dir) and os.path.exists(model_dir + '.old'):
+        # Interrupted between the two renames in save_topic_model
+        model_dir += '.old'
+
+    return (LdaModel.load(os.path.join(model_dir, LDA_FN)),
+            TfidfModel.load(os.path.join(model_dir, TFIDF_FN)),
+            Dictionary.load(os.path.join(model_dir, DICTIONARY_FN)))
+
+
+def _topic_model_watermark(model_dir):
+    return TOPIC_MODEL_WATERMARK % os.path.abspath(model_dir)
+
+
+def _update_lda(lda, chunk):
+    # Models trained in batch mode are saved with update_every=0 and LDA_PASSES, which update() would
+    # otherwise reuse and rerun full batch passes for every chunk instead of folding it in online
+    if isinstance(lda, LdaMulticore):
+        # LdaMulticore.update() is always online and only takes the number of passes from the model
+        passes, lda.passes = lda.passes, UPDATE_PASSES
+
+        try:
+            lda.update(chunk)
+        finally:
+            lda.passes = passes
+    else:
+        lda.update(chunk, passes=UPDATE_PASSES, update_every=1)
+
+
+def update_topic_model(store, model_dir, n_jobs=1, chunksize=UPDATE_CHUNKSIZE):
+    watermark = _topic_model_watermark(model_dir)
+
+    lda, tfidf, dict = load_topic_model(model_dir)
+
+    docs = StoreDocuments(store, n_jobs, store.get_watermark(watermark))
+    corpus = (tfidf[dict.doc2bow(article_to_bow(doc))] for doc in docs)
+
+    num_docs = 0
+
+    for chunk in iter(lambda: list(itertools.islice(corpus, chunksize)), []):
+        _update_lda(lda, chunk)
+        num_docs += len(chunk)
+
+    if num_docs:
+        save_topic_model(model_dir, lda, tfidf, dict)
+
+    if docs.last_row_id is not None:
+        store.set_watermark(watermark, docs.last_row_id)
+
+    logging.info("Updated topic model in %s with %d articles" % (model_dir, num_docs))
+
+    return num_docs
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser()
+    parser.add_option('-s', '--store')
+    parser.add_option('-m', '--model-dir')
+    parser.add_option('-t', '--topics', type=int, default=10)
+    parser.add_option('-j', '--jobs', type=int, default=1)
+    parser.add_option('-w', '--workers', type=int)
+    parser.add_option('--chunksize', type=int, default=LDA_CHUNKSIZE)
+    parser.add_option('--corpus-dir')
+    parser.add_option('--update', action='store_true')
+    parser.add_option('--encoded-corpus', action='store_true')
+
+    opts, args = parser.parse_args()
+
+    if opts.store:
+        store_path = os.path.abspath(opts.store)
+    else:
+        raise ValueError('--store argument is required')
+
+    if opts.model_dir:
+        model_dir = os.path.abspath(opts.model_dir)
+    else:
+        raise ValueError('--model-dir argument is required')
+
+    # Kept outside the model directory, which is replaced on every checkpoint
+    corpus_dir = os.path.abspath(opts.corpus_dir or model_dir + '.corpus')
+
+    with ArticleStore(store_path, index=False) as store:
+        if opts.update:
+            update_topic_model(store, model_dir, opts.jobs)
+        elif opts.encoded_corpus:
+            # Reads the tokens stored by corpus.py instead of tokenizing the archive again
+            lda, tfidf, dictionary = train_lda_model_streaming(EncodedCorpus(corpus_path(store_path)).iter_documents(),
+                                                               corpus_dir, opts.topics, opts.workers, opts.chunksize)
+
+            save_topic_model(model_dir, lda, tfidf, dictionary)
+        else:
+            docs = StoreDocuments(store, opts.jobs)
+            lda, tfidf, dictionary = train_lda_model_streaming(docs, corpus_dir, opts.topics, opts.workers,
+                                                               opts.chunksize)
+
+            save_topic_model(model_dir, lda, tfidf, dictionary)
+
+            if docs.last_row_id is not None:
+                store.set_watermark(_topic_model_watermark(model_dir), docs.last_row_id)